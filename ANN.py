@@ -0,0 +1,171 @@
+import numpy as np
+
+# Number of Lloyd iterations used to train the coarse quantizer
+kmeans_iterations = 20
+# The coarse quantizer is trained on a random sample of at most this many vectors per list
+kmeans_points_per_list = 256
+# Maximum number of rows for which distances are computed at once, bounds the size of the distance matrices
+batch_rows = 4096
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate nearest neighbour search, a drop-in replacement for the kneighbors() part of
+    sklearn's KNeighborsClassifier. The vectors are partitioned into n_lists clusters with k-means and a query is only
+    compared to the vectors of its n_probe nearest clusters. n_probe trades recall for latency, n_probe = n_lists is
+    an exact search.
+    The vectors of list i are vectors[pointers[i]:pointers[i + 1]], their rows in the training data are
+    ids[pointers[i]:pointers[i + 1]]
+    """
+
+    def __init__(self, n_lists=None, n_probe=8, n_neighbors=7, seed=0):
+        """
+        :param n_lists: Number of clusters. None uses the square root of the number of training vectors
+        :param n_probe: Default number of clusters searched per query
+        :param n_neighbors: Default number of neighbours returned per query
+        :param seed: Seed of the k-means initialisation
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_neighbors = n_neighbors
+        self.seed = seed
+        self.centroids = None
+        self.pointers = None
+        self.vectors = None
+        self.ids = None
+
+    def fit(self, X, y=None):
+        """
+        Build the index
+        :param X: The training vectors (samples x dimensions)
+        :param y: Ignored, labels are looked up by the caller through the returned row numbers
+        :return: The index
+        """
+        X = np.asarray(X, dtype=np.float32)
+        n_lists = self.n_lists if self.n_lists is not None else int(round(np.sqrt(X.shape[0])))
+        n_lists = max(1, min(n_lists, X.shape[0]))
+
+        self.centroids = kmeans(X, n_lists, self.seed)
+        assignment = nearest(X, self.centroids)
+
+        # Store the vectors grouped by list, CSR-style
+        order = np.argsort(assignment, kind="stable")
+        self.vectors = X[order]
+        self.ids = order
+        self.pointers = np.searchsorted(assignment[order], np.arange(n_lists + 1))
+        return self
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True, n_probe=None):
+        """
+        Find the approximate nearest neighbours of many queries at once
+        :param X: The query vectors (queries x dimensions)
+        :param n_neighbors: Number of neighbours per query, defaults to the one given at construction
+        :param return_distance: If False, only the neighbour rows are returned
+        :param n_probe: Number of clusters searched per query, defaults to the one given at construction
+        :return: Euclidean distances and training data rows of the neighbours (queries x n_neighbors), nearest first.
+        Queries with fewer than n_neighbors vectors in their clusters are padded with distance inf and row -1
+        """
+        queries = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        k = n_neighbors if n_neighbors is not None else self.n_neighbors
+        n_lists = self.centroids.shape[0]
+        n_probe = min(n_probe if n_probe is not None else self.n_probe, n_lists)
+
+        best_distances = np.full((queries.shape[0], k), np.inf, dtype=np.float32)
+        best_rows = np.full((queries.shape[0], k), -1, dtype=np.int64)
+
+        # Group the queries by the lists they probe
+        probes = smallest(squared_distances(queries, self.centroids), n_probe)
+        query_rows = np.repeat(np.arange(queries.shape[0]), n_probe)
+        lists = probes.ravel()
+        order = np.argsort(lists, kind="stable")
+        query_rows = query_rows[order]
+        bounds = np.searchsorted(lists[order], np.arange(n_lists + 1))
+
+        for i in range(n_lists):
+            start, end = self.pointers[i], self.pointers[i + 1]
+            if start == end:
+                continue
+            probing = query_rows[bounds[i]:bounds[i + 1]]
+            for batch in range(0, probing.size, batch_rows):
+                rows = probing[batch:batch + batch_rows]
+                distances = squared_distances(queries[rows], self.vectors[start:end])
+                candidates = smallest(distances, k)
+
+                # Merge the best candidates of this list with the best ones found so far
+                merged_distances = np.concatenate(
+                    (best_distances[rows], np.take_along_axis(distances, candidates, axis=1)), axis=1)
+                merged_rows = np.concatenate((best_rows[rows], candidates + start), axis=1)
+                keep = smallest(merged_distances, k)
+                best_distances[rows] = np.take_along_axis(merged_distances, keep, axis=1)
+                best_rows[rows] = np.take_along_axis(merged_rows, keep, axis=1)
+
+        # Nearest first, translated to training data rows
+        order = np.argsort(best_distances, axis=1, kind="stable")
+        best_distances = np.take_along_axis(best_distances, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        neighbors = np.where(best_rows >= 0, self.ids[best_rows], -1)
+
+        if not return_distance:
+            return neighbors
+        return np.sqrt(np.maximum(best_distances, 0)), neighbors
+
+
+def kmeans(X, n_clusters, seed=0):
+    """
+    Cluster vectors with Lloyd's algorithm on a random sample
+    :param X: The vectors (samples x dimensions)
+    :param n_clusters: Number of clusters
+    :param seed: Seed of the sampling and initialisation
+    :return: The cluster centroids (n_clusters x dimensions)
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(X.shape[0], n_clusters * kmeans_points_per_list)
+    sample = X[rng.choice(X.shape[0], sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, n_clusters, replace=False)].copy()
+
+    for _ in range(kmeans_iterations):
+        assignment = nearest(sample, centroids)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        sums = np.stack([np.bincount(assignment, weights=sample[:, d], minlength=n_clusters)
+                         for d in range(sample.shape[1])], axis=1)
+
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+        # Restart empty clusters from random sample vectors
+        centroids[~filled] = sample[rng.choice(sample_size, np.count_nonzero(~filled))]
+
+    return centroids
+
+
+def nearest(X, centroids):
+    """
+    Assign vectors to their nearest centroid
+    :param X: The vectors (samples x dimensions)
+    :param centroids: The centroids (clusters x dimensions)
+    :return: The index of the nearest centroid of each vector
+    """
+    return np.concatenate([np.empty(0, dtype=np.int64)]
+                          + [squared_distances(X[start:start + batch_rows], centroids).argmin(axis=1)
+                             for start in range(0, X.shape[0], batch_rows)])
+
+
+def squared_distances(A, B):
+    """
+    Squared Euclidean distances between all rows of two matrices
+    :param A: First matrix (m x dimensions)
+    :param B: Second matrix (n x dimensions)
+    :return: The m x n distance matrix
+    """
+    return (A * A).sum(axis=1)[:, np.newaxis] - 2 * A.dot(B.T) + (B * B).sum(axis=1)[np.newaxis, :]
+
+
+def smallest(distances, k):
+    """
+    Find the k smallest entries of each row (in no particular order)
+    :param distances: The distance matrix
+    :param k: Number of entries per row. Rows with fewer columns return all of them
+    :return: Column indices of the entries (rows x min(k, columns))
+    """
+    if k >= distances.shape[1]:
+        return np.broadcast_to(np.arange(distances.shape[1]), distances.shape)
+    return np.argpartition(distances, k - 1, axis=1)[:, :k]
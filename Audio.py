@@ -0,0 +1,197 @@
+import os
+from functools import lru_cache
+from math import gcd
+
+import numpy as np
+from scipy.io import wavfile
+from scipy.signal import firwin, resample_poly, upfirdn
+
+from Constants import global_sr
+
+try:
+    import soundfile
+except ImportError:
+    # Fall back to scipy's (memory-mapped) wav reader
+    soundfile = None
+
+# Length of the blocks read by blocks() (in seconds)
+block_seconds = 30
+
+
+def load(path, sr=global_sr):
+    """
+    Decode an audio file, convert it to mono and resample it
+    :param path: The path to the audio file or a file-like object holding its content
+    :param sr: The target sampling rate
+    :return: The mono float32 signal at sampling rate sr
+    """
+    sig, sr_file = read(path)
+    return resample(to_mono(sig), sr_file, sr)
+
+
+def read(path):
+    """
+    Decode an audio file
+    :param path: The path to the audio file or a file-like object holding its content
+    :return: The float32 signal (samples or samples x channels) scaled to [-1, 1] and its sampling rate
+    """
+    if soundfile is not None:
+        sig, sr = soundfile.read(path, dtype='float32')
+        return sig, sr
+
+    # Only files on disk can be memory-mapped
+    sr, sig = wavfile.read(path, mmap=isinstance(path, (str, os.PathLike)))
+    return to_float(sig), sr
+
+
+def blocks(path, sr=global_sr, seconds=block_seconds):
+    """
+    Decode a long audio file block by block, convert each block to mono and resample it. The concatenated blocks are
+    equal to load(path, sr)
+    :param path: The path to the audio file
+    :param sr: The target sampling rate
+    :param seconds: The length of a block in seconds of the file
+    :return: Generator yielding mono float32 blocks at sampling rate sr
+    """
+    if soundfile is not None:
+        sr_file = soundfile.info(path).samplerate
+        file_blocks = soundfile.blocks(path, blocksize=int(seconds * sr_file), dtype='float32')
+    else:
+        sr_file, sig = wavfile.read(path, mmap=True)
+        block_size = int(seconds * sr_file)
+        file_blocks = (to_float(sig[start:start + block_size]) for start in range(0, sig.shape[0], block_size))
+
+    resampler = Resampler(sr_file, sr)
+    for block in file_blocks:
+        yield resampler.process(to_mono(block))
+    yield resampler.flush()
+
+
+def to_float(sig):
+    """
+    Convert integer PCM samples to float32 in [-1, 1]
+    :param sig: The samples
+    :return: The float32 samples
+    """
+    if sig.dtype == np.uint8:
+        return (sig.astype(np.float32) - 128) / 128
+    if sig.dtype.kind == 'i':
+        return sig.astype(np.float32) / (float(np.iinfo(sig.dtype).max) + 1)
+    return sig.astype(np.float32, copy=False)
+
+
+def to_mono(sig):
+    """
+    Downmix a signal to mono
+    :param sig: Signal of shape (samples,) or (samples, channels)
+    :return: The mono float32 signal
+    """
+    if sig.ndim == 1:
+        return sig
+    return sig.mean(axis=1, dtype=np.float32)
+
+
+def resample(sig, sr_in, sr_out):
+    """
+    Resample a signal with a polyphase filter
+    :param sig: The signal
+    :param sr_in: Its sampling rate
+    :param sr_out: The target sampling rate
+    :return: The resampled float32 signal
+    """
+    if sr_in == sr_out:
+        return sig
+    up, down = ratio(sr_in, sr_out)
+    return resample_poly(sig, up, down, window=lowpass(up, down)).astype(np.float32)
+
+
+def ratio(sr_in, sr_out):
+    divisor = gcd(int(sr_in), int(sr_out))
+    return int(sr_out) // divisor, int(sr_in) // divisor
+
+
+@lru_cache(maxsize=None)
+def lowpass(up, down):
+    """
+    Design the anti-aliasing filter of a resampling ratio (the same one scipy's resample_poly uses by default). The
+    filter only depends on the ratio, so it is designed once per ratio
+    :param up: Upsampling factor
+    :param down: Downsampling factor
+    :return: The filter taps
+    """
+    max_rate = max(up, down)
+    taps = firwin(2 * 10 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0))
+    taps.setflags(write=False)
+    return taps
+
+
+class Resampler:
+    """
+    Stateful polyphase resampler for signals arriving in blocks. The concatenated output of process() and flush() is
+    equal to resample() of the whole signal
+    """
+
+    def __init__(self, sr_in, sr_out):
+        """
+        :param sr_in: Sampling rate of the input blocks
+        :param sr_out: Target sampling rate
+        """
+        self.up, self.down = ratio(sr_in, sr_out)
+        if self.up == self.down:
+            return
+        taps = lowpass(self.up, self.down)
+        half_len = (taps.size - 1) // 2
+        pre_pad = self.down - half_len % self.down
+        # Filter aligned like resample_poly's, output sample m is sample (m + delay) * down of the filtered signal
+        self.taps = np.concatenate((np.zeros(pre_pad), taps * self.up))
+        self.delay = (half_len + pre_pad) // self.down
+        # Input samples still needed, starting at input sample self.start (always a multiple of down)
+        self.buffer = np.empty(0, dtype=np.float32)
+        self.start = 0
+        self.total_in = 0
+        self.total_out = 0
+
+    def process(self, block):
+        """
+        Resample the next block
+        :param block: The next input samples
+        :return: All output samples which only depend on the input seen so far
+        """
+        if self.up == self.down:
+            return np.asarray(block, dtype=np.float32)
+        self.buffer = np.concatenate((self.buffer, block))
+        self.total_in += len(block)
+        # Output m depends on the input samples up to (m + delay) * down / up
+        end = (self.total_in * self.up - 1) // self.down - self.delay + 1
+        return self.emit(end)
+
+    def flush(self):
+        """
+        Finish the signal
+        :return: The remaining output samples
+        """
+        if self.up == self.down:
+            return np.empty(0, dtype=np.float32)
+        end = -(-self.total_in * self.up // self.down)
+        return self.emit(end)
+
+    def emit(self, end):
+        if end <= self.total_out:
+            return np.empty(0, dtype=np.float32)
+
+        # The buffer starts at a multiple of down, so its filtered samples line up with the output grid
+        filtered = upfirdn(self.taps, self.buffer, self.up, self.down)
+        first = self.total_out + self.delay - self.start * self.up // self.down
+        out = np.zeros(end - self.total_out, dtype=np.float32)
+        # Past the end of the filtered signal the output is zero
+        available = filtered[first:first + out.size]
+        out[:available.size] = available
+        self.total_out = end
+
+        # Drop the input samples which no future output depends on
+        needed = -(-((self.total_out + self.delay) * self.down - (self.taps.size - 1)) // self.up)
+        start = max(self.start, needed // self.down * self.down)
+        self.buffer = self.buffer[start - self.start:]
+        self.start = start
+
+        return out
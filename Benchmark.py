@@ -0,0 +1,382 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from scipy.io import wavfile
+from scipy.signal import chirp
+
+import Database
+import Fingerprint
+import Index
+import Instrumentation
+import Postings
+import SpecCache
+from Constants import global_sr
+
+try:
+    import resource
+except ImportError:
+    # Peak RSS is not reported on platforms without the resource module (Windows)
+    resource = None
+
+# Folder the synthetic catalog, queries and index are generated in
+benchmark_folder = "data" + os.path.sep + "benchmark"
+
+# Default size of the synthetic catalog
+benchmark_tracks = 20
+track_seconds = 30
+benchmark_queries = 20
+query_seconds = 10
+# Standard deviation of the white noise added to the query snippets
+query_noise = 0.05
+benchmark_seed = 0
+
+# Number of times the index is loaded when timing Index.load
+index_loads = 20
+
+# Amplitude of the hum (sustained tones shared by all tracks) mixed into every track. It produces hashes common to
+# the whole catalog, like mains hum or tonal sustain in real recordings
+hum_amplitude = 0.1
+hum_frequencies = (50 * 7, 50 * 15)
+
+# Number of times each query is searched when measuring the max_postings trade-off
+tradeoff_repetitions = 5
+
+# Confidence thresholds compared for the adaptive search (None searches all query hashes)
+adaptive_confidences = (None, 5.0, 4.0, 3.0)
+
+# A stage regresses if its p50 latency grows (or its throughput shrinks) by more than this fraction of the baseline
+regression_tolerance = 0.1
+
+
+def run(folder=benchmark_folder, tracks=benchmark_tracks, queries=benchmark_queries, seed=benchmark_seed):
+    """
+    Benchmark fingerprinting, indexing and search on a synthetic catalog. All spectrograms are computed from scratch,
+    the spectrogram cache is redirected to an empty folder inside the benchmark folder
+    :param folder: The benchmark folder. Its contents are replaced
+    :param tracks: Number of catalog tracks
+    :param queries: Number of query snippets
+    :param seed: Seed of the synthetic audio
+    :return: The results: per stage the number of items, total seconds, throughput, p50/p99 latency and how much the
+    stage raised the peak RSS, and the peak RSS of the whole process
+    """
+    shutil.rmtree(folder, ignore_errors=True)
+    db_folder = folder + os.path.sep + "database_recordings"
+    query_folder = folder + os.path.sep + "query_recordings"
+    index_folder = folder + os.path.sep + "fingerprints"
+    SpecCache.spec_cache = folder + os.path.sep + "spec"
+    SpecCache.cache_bytes = None
+
+    track_paths = synthesize_catalog(db_folder, tracks, seed)
+    query_paths = synthesize_queries(query_folder, track_paths, queries, seed)
+
+    stages = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        # Catalog tracks are fingerprinted with the spectrogram cache, as by the database builder
+        fingerprints = [measure(stages, "compute_fingerprint", Fingerprint.compute_fingerprint, path, None, None, True)
+                        for path in track_paths]
+
+        # Peak picking and hashing on their own, starting from the (now cached) spectrograms
+        for path in track_paths:
+            spec = SpecCache.load(SpecCache.key(path, Fingerprint.spec_params))
+            frames, freqs = measure(stages, "detect_peaks", Fingerprint.detect_peaks, spec)
+            measure(stages, "create_hash", Fingerprint.create_hash, frames, freqs)
+
+        song_keys, song_offsets = zip(*fingerprints)
+        index = measure(stages, "index_build", Index.build, song_keys, song_offsets)
+        stages["index_build"]["postings"] = int(index.song_ids.size)
+        Index.append(index, index_folder)
+        Index.save_names([str(path) for path in track_paths], index_folder)
+
+        for _ in range(index_loads):
+            database = measure(stages, "index_load", Index.load, index_folder)
+        ids_names = Index.load_names(index_folder)
+
+        query_fingerprints = [measure(stages, "query_fingerprint", Fingerprint.compute_fingerprint, path)
+                              for path in query_paths]
+        correct = 0
+        for path, fp_query in zip(query_paths, query_fingerprints):
+            results = measure(stages, "search", Database.search, database, ids_names, fp_query)
+            correct += is_correct(path, results)
+
+        stats = Index.posting_stats(database)
+        cutoffs = [None] + sorted({max(1, int(stats[p])) for p in ("p999", "p99", "p90") if p in stats}, reverse=True)
+        tradeoff = max_postings_tradeoff(database, ids_names, query_paths, query_fingerprints, cutoffs)
+        adaptive = adaptive_search_tradeoff(database, ids_names, query_paths, query_fingerprints,
+                                            adaptive_confidences)
+        compression = Postings.measure(index, [fp_query[0] for fp_query in query_fingerprints])
+
+    return {"config": {"tracks": tracks, "track_seconds": track_seconds, "queries": queries,
+                       "query_seconds": query_seconds, "seed": seed, "sr": global_sr},
+            "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                            "platform": platform.platform(), "cpus": os.cpu_count()},
+            "accuracy": correct / max(queries, 1),
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": {name: summarise(stage) for name, stage in stages.items()},
+            "posting_stats": stats,
+            "max_postings_tradeoff": tradeoff,
+            "adaptive_search_tradeoff": adaptive,
+            "posting_compression": compression}
+
+
+def max_postings_tradeoff(database, ids_names, query_paths, query_fingerprints, cutoffs):
+    """
+    Measure search latency, postings touched and accuracy for several query-time posting list cutoffs
+    :param database: The loaded index
+    :param ids_names: The song id to name map
+    :param query_paths: The query files, named "<track>-snippet-<i>.wav"
+    :param query_fingerprints: Their fingerprints
+    :param cutoffs: The max_postings values to compare (None for no cutoff)
+    :return: List with one entry per cutoff: max_postings, accuracy, p50/p99 search latency (ms) and the mean number
+    of postings touched per query
+    """
+    tradeoff = []
+    for cutoff in cutoffs:
+        stages = {}
+        correct = 0
+        touched = 0
+        for path, fp_query in zip(query_paths, query_fingerprints):
+            for _ in range(tradeoff_repetitions):
+                results = measure(stages, "search", Database.search, database, ids_names, fp_query, 3, cutoff)
+            correct += is_correct(path, results)
+            touched += database.lookup(fp_query[0], cutoff)[1].size
+        summary = summarise(stages["search"]) if stages else {"p50_ms": None, "p99_ms": None}
+        tradeoff.append({"max_postings": cutoff,
+                         "accuracy": correct / max(len(query_paths), 1),
+                         "p50_ms": summary["p50_ms"],
+                         "p99_ms": summary["p99_ms"],
+                         "postings_per_query": touched / max(len(query_paths), 1)})
+    return tradeoff
+
+
+def adaptive_search_tradeoff(database, ids_names, query_paths, query_fingerprints, confidences):
+    """
+    Measure search latency, query hashes used and accuracy of Database.search_adaptive for several confidence thresholds
+    :param database: The loaded index
+    :param ids_names: The song id to name map
+    :param query_paths: The query files, named "<track>-snippet-<i>.wav"
+    :param query_fingerprints: Their fingerprints
+    :param confidences: The confidence thresholds to compare (None never stops early)
+    :return: List with one entry per threshold: confidence, accuracy, p50/p99 search latency (ms), the mean number of
+    query hashes used and the share of queries stopped early
+    """
+    # The hashes used and early stops are taken from the instrumentation counters
+    was_enabled = Instrumentation.enabled
+    Instrumentation.enable()
+    tradeoff = []
+    try:
+        for confidence in confidences:
+            stages = {}
+            correct = 0
+            before = Instrumentation.snapshot()
+            for path, fp_query in zip(query_paths, query_fingerprints):
+                results = measure(stages, "search", Database.search_adaptive, database, ids_names, fp_query, 3,
+                                  confidence)
+                correct += is_correct(path, [name for name, _ in results])
+            after = Instrumentation.snapshot()
+            hashes = after["summaries"].get("query_hashes", {}).get("sum", 0) \
+                - before["summaries"].get("query_hashes", {}).get("sum", 0)
+            stops = after["counters"].get("early_stops", 0) - before["counters"].get("early_stops", 0)
+            summary = summarise(stages["search"]) if stages else {"p50_ms": None, "p99_ms": None}
+            tradeoff.append({"confidence": confidence,
+                             "accuracy": correct / max(len(query_paths), 1),
+                             "p50_ms": summary["p50_ms"],
+                             "p99_ms": summary["p99_ms"],
+                             "hashes_per_query": hashes / max(len(query_paths), 1),
+                             "early_stop_share": stops / max(len(query_paths), 1)})
+    finally:
+        Instrumentation.enable(was_enabled)
+    return tradeoff
+
+
+def is_correct(query_path, results):
+    return len(results) > 0 and Path(results[0]).stem == Path(query_path).name.split("-")[0]
+
+
+def measure(stages, name, function, *args):
+    """
+    Call a function and record its latency and its growth of the process's peak RSS under a stage. The peak only
+    grows over the lifetime of the process, so a stage is charged with the amount it raised it by
+    :param stages: Dict of stages, the stage is created on first use
+    :param name: The stage name
+    :param function: The function
+    :param args: Its arguments
+    :return: The result of the function
+    """
+    peak_before = peak_rss_mb()
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+
+    stage = stages.setdefault(name, {"latencies": [], "peak_rss_growth_mb": 0.0 if peak_before is not None else None})
+    stage["latencies"].append(seconds)
+    if peak_before is not None:
+        stage["peak_rss_growth_mb"] += peak_rss_mb() - peak_before
+    return result
+
+
+def summarise(stage):
+    """
+    Summarise the latencies of a stage
+    :param stage: The stage recorded by measure()
+    :return: Dict with the number of items, total seconds, items per second, p50/p99/max latency (ms) and peak RSS
+    growth (MB)
+    """
+    latencies = np.array(stage.pop("latencies"))
+    summary = {"items": int(latencies.size),
+               "total_s": float(latencies.sum()),
+               "throughput_per_s": float(latencies.size / latencies.sum()) if latencies.sum() > 0 else None,
+               "p50_ms": float(np.percentile(latencies, 50) * 1000),
+               "p99_ms": float(np.percentile(latencies, 99) * 1000),
+               "max_ms": float(latencies.max() * 1000)}
+    summary.update(stage)
+    return summary
+
+
+def peak_rss_mb():
+    """
+    :return: The peak resident set size of the process in MB, None if unknown
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def synthesize_catalog(folder, tracks, seed=benchmark_seed):
+    """
+    Generate a catalog of synthetic tracks: each track is a sequence of notes mixing steady tones, chirps and noise
+    :param folder: The folder to write the *.wav files to
+    :param tracks: Number of tracks
+    :param seed: Seed of the random generator
+    :return: The paths of the tracks
+    """
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(tracks):
+        path = folder + os.path.sep + "synth.%05d.wav" % i
+        write_wav(path, synthesize_track(rng, track_seconds))
+        paths.append(path)
+    return paths
+
+
+def synthesize_track(rng, seconds, sr=global_sr):
+    """
+    Synthesize one track
+    :param rng: The random generator
+    :param seconds: Length of the track
+    :param sr: Sampling rate
+    :return: The float signal in [-1, 1]
+    """
+    sig = np.zeros(int(seconds * sr))
+    start = 0
+    while start < sig.size:
+        length = min(int(rng.uniform(0.1, 0.6) * sr), sig.size - start)
+        t = np.arange(length) / sr
+        # Each note holds a few tones and possibly a chirp, with a decaying envelope
+        note = sum(rng.uniform(0.2, 1) * np.sin(2 * np.pi * rng.uniform(100, sr / 2 - 400) * t + rng.uniform(0, 6.3))
+                   for _ in range(rng.integers(1, 5)))
+        if rng.random() < 0.3:
+            note = note + chirp(t, rng.uniform(100, sr / 2 - 400), max(t[-1], 1 / sr), rng.uniform(100, sr / 2 - 400))
+        note = note * np.exp(-t * rng.uniform(1, 8))
+        sig[start:start + length] = note
+        start += length
+    # Background noise and hum mix
+    sig += 0.05 * rng.standard_normal(sig.size)
+    t = np.arange(sig.size) / sr
+    sig += sum(hum_amplitude * np.sin(2 * np.pi * frequency * t) for frequency in hum_frequencies)
+    return 0.9 * sig / np.abs(sig).max()
+
+
+def synthesize_queries(folder, track_paths, queries, seed=benchmark_seed):
+    """
+    Cut noisy snippets of random catalog tracks, named like the query recordings ("<track>-snippet-<i>.wav")
+    :param folder: The folder to write the *.wav files to
+    :param track_paths: The catalog tracks
+    :param queries: Number of snippets
+    :param seed: Seed of the random generator
+    :return: The paths of the snippets
+    """
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed + 1)
+    paths = []
+    for i in range(queries):
+        track_path = track_paths[rng.integers(len(track_paths))]
+        sr, track = wavfile.read(track_path)
+        length = int(query_seconds * sr)
+        start = rng.integers(0, max(track.size - length, 1))
+        snippet = track[start:start + length] / 32768 + query_noise * rng.standard_normal(min(length, track.size))
+        path = folder + os.path.sep + Path(track_path).stem + "-snippet-%d.wav" % i
+        write_wav(path, np.clip(snippet, -1, 1))
+        paths.append(path)
+    return paths
+
+
+def write_wav(path, sig, sr=global_sr):
+    wavfile.write(path, sr, (sig * 32767).astype(np.int16))
+
+
+def compare(results, baseline, tolerance=regression_tolerance):
+    """
+    Compare benchmark results to a baseline
+    :param results: The results of run()
+    :param baseline: Earlier results of run()
+    :param tolerance: Allowed relative slowdown
+    :return: List of regressions, one message per stage and metric
+    """
+    regressions = []
+    for name, stage in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        base = baseline["stages"][name]
+        if stage["p50_ms"] > base["p50_ms"] * (1 + tolerance):
+            regressions.append(name + ": p50 " + str(round(base["p50_ms"], 2)) + "ms -> "
+                               + str(round(stage["p50_ms"], 2)) + "ms")
+        if stage["throughput_per_s"] is not None and base["throughput_per_s"] is not None \
+                and stage["throughput_per_s"] < base["throughput_per_s"] / (1 + tolerance):
+            regressions.append(name + ": throughput " + str(round(base["throughput_per_s"], 2)) + "/s -> "
+                               + str(round(stage["throughput_per_s"], 2)) + "/s")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark fingerprinting, indexing and search on synthetic audio")
+    parser.add_argument("--tracks", type=int, default=benchmark_tracks)
+    parser.add_argument("--queries", type=int, default=benchmark_queries)
+    parser.add_argument("--seed", type=int, default=benchmark_seed)
+    parser.add_argument("--folder", default=benchmark_folder)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare the results to this JSON file, exit with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=regression_tolerance)
+    args = parser.parse_args(argv)
+
+    results = run(args.folder, args.tracks, args.queries, args.seed)
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(report)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Regression: " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+# Example use from command line:
+# python Benchmark.py --tracks 50 --output baseline.json
+# python Benchmark.py --tracks 50 --baseline baseline.json
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,13 +4,19 @@ from math import ceil
 # Folder storing database recordings
 database_recordings = "database_recordings"
 query_recordings = "query_recordings"
-generated = "generated"
 
 # Path to wavs
 wav_path = "data" + os.path.sep + database_recordings
 
 # Name of stored classifier (k nearest neighbors trained with sklearn)
 clf_name = "nearestNeighbor.joblib"
+# Label table of the classifier (track id, frame index and start time of each training frame) and the track names it
+# refers to
+labels_name = "nearestNeighborLabels.npy"
+label_tracks_name = "nearestNeighborTracks.npy"
+
+# Folder of the feature store holding the fingerprints of all database recordings (Ramona approach)
+feature_store = "data" + os.path.sep + "features"
 
 
 # Sampling rate used throughout the system
@@ -31,4 +37,36 @@ first_stft_sr = 40
 
 # Second STFT parameters
 window_length_2 = 2 * first_stft_sr
-hop_size_2 = int(0.5 * first_stft_sr)
\ No newline at end of file
+hop_size_2 = int(0.5 * first_stft_sr)
+
+# Spectrogram cache
+# Folder storing cached spectrograms
+spec_cache = "data" + os.path.sep + "spec"
+# Maximum total size of the spectrogram cache in bytes. Least recently used spectrograms are evicted above it
+spec_cache_max_bytes = 4 * 1024 ** 3
+
+
+# Streaming identification
+# Length of the blocks of final peaks which are hashed together (in seconds)
+stream_block_seconds = 5
+# Time between two consecutive (overlapping) blocks (in seconds)
+stream_hop_seconds = 1
+# Only matches from this many most recent seconds of the stream are kept for scoring
+stream_window_seconds = 30
+# Minimum offset-histogram score (number of time-aligned matching hashes) for reporting a match
+stream_min_score = 8
+
+
+# Nearest-neighbour search of the Ramona approach
+# Backend used to match frame vectors: "ivf" (approximate, inverted file index) or "exact" (sklearn k nearest neighbors)
+ann_backend = "ivf"
+# Number of clusters of the inverted file index. None uses the square root of the number of frame vectors
+ann_n_lists = None
+# Number of clusters searched per query frame. Higher values improve recall at the cost of latency
+ann_n_probe = 8
+
+# Offset voting of the Ramona approach
+# Number of query frames matched at once before the early exit test
+rp_query_chunk_frames = 32
+# A query stops as soon as one candidate has this many time-consistent neighbour votes. None matches all frames
+rp_early_exit_score = 16
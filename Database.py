@@ -1,61 +1,170 @@
-from collections import Counter
+import numpy as np
 
+import Instrumentation
 
-def search(database, ids_names, fp_query):
+# Query hashes with more postings than this (in a segment) are ignored, bounding the worst-case query cost. None uses
+# all hashes. See Index.build_max_postings for the build-time stop-list
+query_max_postings = None
+
+# Adaptive search (search_adaptive): number of query hashes looked up per step and the margin, in standard deviations,
+# by which the best song has to lead the runner-up before the remaining hashes are skipped
+search_chunk_hashes = 200
+search_confidence = 5.0
+
+
+def search(database, ids_names, fp_query, top_k=3, max_postings=query_max_postings):
     """
     Search the database for a query
-    :param database: The database object
+    :param database: The database object (Index.FingerprintIndex)
     :param ids_names: The map from song ids to names
-    :param fp_query: The query fingerprint (collection of hashes)
-    :return: The names of the three best matches
+    :param fp_query: The query fingerprint (arrays of hash keys and offsets)
+    :param top_k: The number of matches to return
+    :param max_postings: Query hashes with more postings than this are ignored. None uses all hashes
+    :return: The names of the top_k best matches
     """
-    matches = {}
-    for (hash_q, offset_q) in fp_query:
-        # Get hash value
-        hash_q_digest = hash_q.digest()
-        try:
-            # Find associated tuples
-            db_lookup = database[hash_q_digest]
-            for item in db_lookup:
-                song_id = item[0]
-                db_offset = item[1]
-                if song_id in matches:
-                    matches[song_id].append((db_offset, offset_q))
-                else:
-                    matches[song_id] = [(db_offset, offset_q)]
-        except KeyError:
-            # Hash not found in db
-            continue
-
-    # Order matches by song id
-    matches = {k: v for k, v in sorted(matches.items(), key=lambda item: item[0])}
+    keys_q, offsets_q = fp_query
 
-    # Initialise candidates
-    candidates = {}
+    # Find all postings of the query hashes
+    with Instrumentation.timer("lookup"):
+        query_idx, song_ids, db_offsets = database.lookup(keys_q, max_postings)
+    Instrumentation.observe("query_hashes", len(keys_q))
+    Instrumentation.observe("postings_touched", song_ids.size)
+    if song_ids.size == 0:
+        return []
 
-    # Group each song into histogram bins
-    for song_id in matches.keys():
-        pairs = matches[song_id]
-        offset_diffs = []
-        # Calculate offset diff for each match of current song
-        for pair in pairs:
-            offset_diffs.append(pair[0] - pair[1])
+    with Instrumentation.timer("scoring"):
+        # Offset difference of each match
+        offset_diffs = db_offsets.astype(np.int64) - np.asarray(offsets_q, dtype=np.int64)[query_idx]
 
-        # Find most common time-difference value for current song
-        most_common = Counter(offset_diffs).most_common(1)
-        maximum = most_common[0][1]
-        # Maximum value represents this songs viability as a candidate
-        candidates[song_id] = maximum
+        # Maximum histogram bin of each song represents its viability as a candidate
+        candidates, scores = histogram_peaks(song_ids, offset_diffs)
 
-    # Select best three
-    matches = [k for k, v in sorted(candidates.items(), key=lambda item: item[1], reverse=True)]
-    best_three = matches[:3]
+        # Select best ones, ties are resolved by song id
+        best = candidates[np.lexsort((candidates, -scores))[:top_k]]
 
     # Lookup the song names from the ids
-    song_names = [ids_names[best] for best in best_three]
+    song_names = [ids_names[song_id] for song_id in best]
 
     return song_names
 
+
+def search_adaptive(database, ids_names, fp_query, top_k=3, confidence=search_confidence,
+                    chunk_hashes=search_chunk_hashes, max_postings=query_max_postings):
+    """
+    Search the database for a query, stopping early once the best match is certain. The query hashes are looked up
+    chunk by chunk in query order, the matches of each chunk are added to the running (song, offset difference)
+    histogram. Matches of unrelated songs spread over many bins, so the bin counts of all but the true song are small
+    and noisy. Treating the fullest bins of the leader (s1) and runner-up (s2) as Poisson counts, the search stops once
+    (s1 - s2) / sqrt(s1 + s2) >= confidence. Without early stop the results equal those of search()
+    :param database: The database object (Index.FingerprintIndex)
+    :param ids_names: The map from song ids to names
+    :param fp_query: The query fingerprint (arrays of hash keys and offsets)
+    :param top_k: The number of matches to return. Only the first one is guaranteed to be decided on early stop
+    :param confidence: The margin (in standard deviations) at which the search stops. None never stops early
+    :param chunk_hashes: Number of query hashes looked up per step
+    :param max_postings: Query hashes with more postings than this are ignored. None uses all hashes
+    :return: List of (name, score) of the top_k best matches, the score is the size of the fullest histogram bin
+    """
+    keys_q, offsets_q = fp_query
+    keys_q = np.asarray(keys_q)
+    offsets_q = np.asarray(offsets_q, dtype=np.int64)
+
+    songs = offset_diffs = counts = np.empty(0, dtype=np.int64)
+    candidates = scores = np.empty(0, dtype=np.int64)
+    used = 0
+    while used < keys_q.size:
+        chunk = slice(used, used + chunk_hashes)
+        used += chunk_hashes
+        with Instrumentation.timer("lookup"):
+            query_idx, song_ids, db_offsets = database.lookup(keys_q[chunk], max_postings)
+        Instrumentation.observe("postings_touched", song_ids.size)
+        if song_ids.size == 0:
+            continue
+
+        with Instrumentation.timer("scoring"):
+            # Merge the matches of this chunk into the running histogram
+            new_diffs = db_offsets.astype(np.int64) - offsets_q[chunk][query_idx]
+            songs, offset_diffs, counts = histogram(np.concatenate((songs, song_ids)),
+                                                    np.concatenate((offset_diffs, new_diffs)),
+                                                    weights=np.concatenate((counts, np.ones(song_ids.size,
+                                                                                            dtype=np.int64))))
+            candidates, scores = histogram_maxima(songs, counts)
+            if confidence is not None and is_decisive(scores, confidence):
+                Instrumentation.count("early_stops")
+                break
+    Instrumentation.observe("query_hashes", min(used, keys_q.size))
+
+    # Select best ones, ties are resolved by song id
+    order = np.lexsort((candidates, -scores))[:top_k]
+    return [(ids_names[song_id], int(score)) for song_id, score in zip(candidates[order], scores[order])]
+
+
+def is_decisive(scores, confidence):
+    """
+    Check whether the best score leads the second best one by a statistically clear margin
+    :param scores: The score of each candidate
+    :param confidence: The required margin in standard deviations
+    :return: True if (s1 - s2) / sqrt(s1 + s2) >= confidence
+    """
+    if scores.size == 0:
+        return False
+    # Second best is 0 if there is a single candidate
+    s2, s1 = np.partition(np.append(scores, 0), scores.size - 1)[-2:]
+    return s1 - s2 >= confidence * np.sqrt(s1 + s2)
+
+
+def histogram_peaks(song_ids, offset_diffs):
+    """
+    Group the matches of each song into offset difference histogram bins and find the fullest bin
+    :param song_ids: Song id of each match
+    :param offset_diffs: Offset difference (database offset - query offset) of each match
+    :return: The sorted unique song ids and the size of the fullest histogram bin of each song
+    """
+    songs, _, counts = histogram(song_ids, offset_diffs)
+    return histogram_maxima(songs, counts)
+
+
+def histogram(song_ids, offset_diffs, weights=None):
+    """
+    Count the matches of each (song, offset difference) histogram bin
+    :param song_ids: Song id of each match
+    :param offset_diffs: Offset difference (database offset - query offset) of each match
+    :param weights: Optional number of matches each entry stands for, used to merge histograms
+    :return: Song id, offset difference and count of each non-empty bin, sorted by song id and offset difference
+    """
+    if song_ids.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    # Combine song id and offset difference into one key, so every (song, diff) bin is one unique value
+    base = offset_diffs.min()
+    offset_diffs = offset_diffs - base
+    span = offset_diffs.max() + 1
+    combined = song_ids.astype(np.int64) * span + offset_diffs
+    if weights is None:
+        bins, counts = np.unique(combined, return_counts=True)
+    else:
+        bins, inverse = np.unique(combined, return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=weights, minlength=bins.size).astype(np.int64)
+
+    return bins // span, bins % span + base, counts
+
+
+def histogram_maxima(songs, counts):
+    """
+    Find the fullest histogram bin of each song
+    :param songs: Song id of each bin, sorted
+    :param counts: Count of each bin
+    :return: The sorted unique song ids and the size of the fullest histogram bin of each song
+    """
+    if songs.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    # Bins are sorted by song id, so the bins of each song are contiguous
+    unique_songs, starts = np.unique(songs, return_index=True)
+    maxima = np.maximum.reduceat(counts, starts)
+
+    return unique_songs, maxima
+
 # def initialise():
 #     # Create full db if not exists
 #     if not os.path.exists("db_S.pkl"):
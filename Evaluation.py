@@ -1,13 +1,13 @@
 import os
-import pickle
 from pathlib import Path
 
 import numpy as np
 
+import Index
 import Main
 
-database = {}
-ids_names = {}
+database = None
+ids_names = None
 
 def evaluate_all():
     """
@@ -15,11 +15,9 @@ def evaluate_all():
     :return: None
     """
     global database, ids_names
-    # Load database from file
-    db_file = open("fingerprints" + os.path.sep + "db_S.pkl", "rb")
-    ids_names_file = open("fingerprints" + os.path.sep + "ids_names.pkl", "rb")
-    database = pickle.load(db_file)
-    ids_names = pickle.load(ids_names_file)
+    # Memory-map database from file
+    database = Index.load("fingerprints")
+    ids_names = Index.load_names("fingerprints")
 
     # Path to wavs
     wav_path = "data" + os.path.sep + "query_recordings"
@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+
+import Utility
+
+# Files of a feature store: the features of all tracks as one raw float32 matrix, the start time of each feature row
+# as raw int32 and the table of tracks. A track's rows are features[start:start + count]
+features_file = "features.f32"
+times_file = "times.i32"
+tracks_file = "tracks.npy"
+
+
+def tracks_dtype(name_length=1):
+    """
+    :param name_length: Number of characters of the name field, the table is widened as longer names are appended
+    :return: The dtype of the track table
+    """
+    return np.dtype([("name", "U" + str(name_length)), ("start", np.int64), ("count", np.int64)])
+
+
+# Number of values in one feature row (a flattened 6x6 fingerprint frame)
+feature_size = 36
+
+
+def append(folder, names, fingerprints, times):
+    """
+    Append the features of tracks to a feature store. The rows are added to the end of the data files in place and
+    become visible with the atomic update of the track table, so readers never see partially written tracks
+    :param folder: The feature store folder. It is created if it does not exist
+    :param names: The names of the tracks
+    :param fingerprints: The fingerprint of each track (frames x 6 x 6)
+    :param times: The start times of the frames of each track
+    :return: None
+    """
+    os.makedirs(folder, exist_ok=True)
+    tracks = load_tracks(folder)
+    end = int(tracks["start"][-1] + tracks["count"][-1]) if tracks.size > 0 else 0
+
+    # Size the name field to the longest name, so that no name is truncated
+    names = [str(name) for name in names]
+    name_length = max([tracks.dtype["name"].itemsize // 4] + [len(name) for name in names] + [1])
+    tracks = tracks.astype(tracks_dtype(name_length))
+    new_tracks = np.empty(len(names), dtype=tracks_dtype(name_length))
+    with open(folder + os.path.sep + features_file, "ab") as feature_file, \
+            open(folder + os.path.sep + times_file, "ab") as time_file:
+        # Drop rows left behind by an interrupted append
+        feature_file.truncate(end * feature_size * 4)
+        time_file.truncate(end * 4)
+
+        for i, (name, fingerprint, track_times) in enumerate(zip(names, fingerprints, times)):
+            rows = np.asarray(fingerprint, dtype=np.float32).reshape(len(track_times), feature_size)
+            feature_file.write(rows.tobytes())
+            time_file.write(np.asarray(track_times, dtype=np.int32).tobytes())
+            new_tracks[i] = (name, end, rows.shape[0])
+            end += rows.shape[0]
+
+    Utility.save_atomic(folder + os.path.sep + tracks_file, np.append(tracks, new_tracks))
+
+
+def load(folder, mmap=True):
+    """
+    Load a feature store
+    :param folder: The feature store folder
+    :param mmap: If True, features and times are memory-mapped read-only instead of being read into memory
+    :return: The features of all tracks (rows x feature_size, float32), the start time of each row and the track table
+    """
+    tracks = load_tracks(folder)
+    rows = int(tracks["start"][-1] + tracks["count"][-1]) if tracks.size > 0 else 0
+    features = read_raw(folder + os.path.sep + features_file, np.float32, rows * feature_size, mmap)
+    times = read_raw(folder + os.path.sep + times_file, np.int32, rows, mmap)
+    return features.reshape(rows, feature_size), times, tracks
+
+
+def load_tracks(folder):
+    """
+    Load the track table of a feature store
+    :param folder: The feature store folder
+    :return: Array of tracks_dtype(), empty if the store does not exist yet
+    """
+    if not os.path.exists(folder + os.path.sep + tracks_file):
+        return np.empty(0, dtype=tracks_dtype())
+    return np.load(folder + os.path.sep + tracks_file)
+
+
+def read_raw(path, dtype, count, mmap=True):
+    """
+    Read the first count values of a raw binary file
+    :param path: The file path
+    :param dtype: The type of the values
+    :param count: Number of values to read
+    :param mmap: If True, the values are memory-mapped read-only
+    :return: The array of values
+    """
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    if mmap:
+        return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+    return np.fromfile(path, dtype=dtype, count=count)
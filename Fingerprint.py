@@ -1,12 +1,13 @@
 import hashlib
-import os
-from pathlib import Path
+import io
 
 import librosa
 import numpy as np
-from scipy.ndimage.morphology import generate_binary_structure, iterate_structure
-from skimage.feature import peak_local_max
+from scipy.ndimage import maximum_filter1d
 
+import Audio
+import Instrumentation
+import SpecCache
 from Constants import global_sr, N_FFT, HOP_SIZE
 
 # Fan out
@@ -15,6 +16,11 @@ fan_out = 40
 # Neighbourhood size
 peak_neighbourhood_size = 12
 
+# Optional amplitude floor (in dB), peaks must be above it. None keeps all peaks above the spectrogram minimum
+peak_amp_min = None
+# Optional maximum number of peaks per frame, the strongest ones are kept. None for no limit
+peak_max_per_frame = None
+
 # Minimum value for allowed time difference (in frames)
 hash_time_delta_min = 1
 # Maximum value for allowed time difference (in frames)
@@ -25,109 +31,160 @@ hash_time_delta_max = 400
 # will be considered
 freq_margin = 80
 
+# Bit widths used to pack (freq1, freq2, t_diff) into a single integer hash key
+freq_bits = int(N_FFT // 2).bit_length()
+time_delta_bits = int(hash_time_delta_max).bit_length()
+key_bits = 2 * freq_bits + time_delta_bits
+# Keys fit into 32 bits for the default parameters, larger settings fall back to 64 bits
+key_dtype = np.uint32 if key_bits <= 32 else np.uint64
+
+# Parameters the cached spectrograms depend on, part of their cache key
+spec_params = ("power_db", N_FFT, HOP_SIZE, global_sr, "hann", "polyphase")
 
-def compute_fingerprint(path):
+
+def compute_fingerprint(path, data=None, digest=None, cache=False):
     """
        Compute the fingerpringt for a given signal
        :param path: The path to the audio file
-       :return: The fingerprint
+       :param data: Optional content of the file, already read into memory. The file is then not accessed
+       :param digest: Optional SHA-1 digest of the content if already known, saves hashing the file for the cache key
+       :param cache: If True, the spectrogram is looked up in and stored to the spectrogram cache (by file content and
+       STFT parameters). Only worth it for files fingerprinted again later (database recordings), not for queries
+       :return: The fingerprint as two arrays: hash keys and anchor offsets
        """
 
-    # Store spectrogram if not there
-    filename = str(path).split(os.path.sep)[-1]
-    specpath = "data" + os.path.sep + "spec" + os.path.sep + filename
-    # Create folder for saved spectrograms if not exists
-    if not os.path.exists("data" + os.path.sep + "spec"):
-        Path("data" + os.path.sep + "spec").mkdir(parents=True, exist_ok=True)
-    if os.path.exists(specpath + ".npy"):
-        stft = np.load(specpath + ".npy")
-    else:
-        # Load signal and sample rate
-        sig, sr = librosa.load(path, sr=None)
-
-        # Convert signal to mono
-        sig = librosa.core.to_mono(sig)
-
-        # Resample to global_sr (8000Hz)
-        if sr != global_sr:
-            sig = librosa.resample(sig, sr, global_sr)
-
-        stft = np.abs(librosa.core.stft(sig,
-                                        n_fft=N_FFT,
-                                        hop_length=HOP_SIZE,
-                                        window='hann',
-                                        pad_mode='constant'
-                                        )) ** 2
-
-        # Convert to dB scale
-        stft = librosa.core.power_to_db(stft)
-        # np.save(specpath, stft)
+    stft = None
+    if cache:
+        if digest is None and data is not None:
+            digest = hashlib.sha1(data).hexdigest()
+        spec_key = SpecCache.key(path, spec_params, digest)
+        stft = SpecCache.load(spec_key)
+    if stft is None:
+        # Load signal, convert it to mono and resample to global_sr (8000Hz)
+        with Instrumentation.timer("decode"):
+            sig = Audio.load(path if data is None else io.BytesIO(data), global_sr)
+
+        with Instrumentation.timer("stft"):
+            stft = np.abs(librosa.core.stft(sig,
+                                            n_fft=N_FFT,
+                                            hop_length=HOP_SIZE,
+                                            window='hann',
+                                            pad_mode='constant'
+                                            )) ** 2
+
+            # Convert to dB scale
+            stft = librosa.core.power_to_db(stft)
+        if cache:
+            SpecCache.store(spec_key, stft)
 
     # Calculate peak times (in stft frames and their corresponding frequencies)
-    frames, freqs = detect_peaks(stft)
+    with Instrumentation.timer("peaks"):
+        frames, freqs = detect_peaks(stft)
 
     # Generate hash
-    hashes = create_hash(frames, freqs)
+    with Instrumentation.timer("hashing"):
+        keys, offsets = create_hash(frames, freqs)
+    Instrumentation.count("fingerprints")
+    Instrumentation.count("hashes", len(keys))
 
     # Notify user
-    print("Created fingerprint for " + str(path))
-    print("Number of hashes found: " + str(len(hashes)))
-    print()
+    Instrumentation.log("Created fingerprint for " + str(path) + ", number of hashes found: " + str(len(keys)))
 
-    return hashes
+    return keys, offsets
 
 def create_hash(frames, freqs):
     """
     Creates a collection of hashes from two given sets of frametimes and frequency-bin values
     :param frames: Collection of frame times
     :param freqs: Collection of frequency bin values
-    :return: The generated hashes
+    :return: Two arrays: the integer hash keys and the offsets (frame times) of their anchor peaks
     """
-    # Brute force hash generation by comparing each peak to its neighbors in the zone regulated
-    # By the fan value and the freq_margin
-    hashes = []
-    for i in range(frames.size):
-        for j in range(1, fan_out):
-            if i + j < frames.size:
-                # Get frequencies
-                freq1 = freqs[i]
-                freq2 = freqs[i + j]
-
-                # Get times
-                t1 = frames[i]
-                t2 = frames[i + j]
-
-                # Get time difference
-                t_diff = t2 - t1
-
-                # Check whether second peak is in time-frequency window
-                if hash_time_delta_min <= t_diff <= hash_time_delta_max \
-                        and freq2 - freq_margin <= freq1 <= freq2 + freq_margin:
-                    # Create hash
-                    value = str(freq1) + "|" + str(freq2) + "|" + str(t_diff)
-                    gen_hash = hashlib.sha1(value.encode('utf-8'))
-                    # Append hash and offset
-                    hashes.append((gen_hash, t1))
-
-    return hashes
-
-def detect_peaks(spec):
+    anchors, partners = pair_peaks(frames, freqs)
+
+    # Pack (freq1, freq2, t_diff) into one integer key
+    freq1 = freqs[anchors].astype(key_dtype)
+    freq2 = freqs[partners].astype(key_dtype)
+    t_diff = (frames[partners] - frames[anchors]).astype(key_dtype)
+    keys = (freq1 << (freq_bits + time_delta_bits)) | (freq2 << time_delta_bits) | t_diff
+
+    # Offset of each hash is the frame time of its anchor peak
+    offsets = frames[anchors].astype(np.int32)
+
+    return keys, offsets
+
+def pair_peaks(frames, freqs):
     """
-    Take a spectrogram and compute local peaks
+    Pairs each peak with its neighbours in the zone regulated by the fan value and the freq_margin
+    :param frames: Collection of frame times
+    :param freqs: Collection of frequency bin values
+    :return: Two index arrays (anchor, partner), ordered by anchor and then by distance to the anchor
     """
+    frames = np.asarray(frames)
+    freqs = np.asarray(freqs)
 
-    # Binary structure defining the neighborhood
-    struct = generate_binary_structure(2, 2)
-    neighborhood = iterate_structure(struct, peak_neighbourhood_size)
+    # Candidate partners of peak i are the peaks i + 1 ... i + fan_out - 1
+    anchors = np.arange(frames.size)[:, np.newaxis]
+    partners = anchors + np.arange(1, fan_out)[np.newaxis, :]
+    in_range = partners < frames.size
+    partners = np.where(in_range, partners, 0)
 
-    # skimage approach to find 2d local peaks
-    freq_time = peak_local_max(spec, footprint=neighborhood)
-    time = freq_time[:, 1]
-    freq = freq_time[:, 0]
+    # Check whether second peak is in time-frequency window
+    t_diff = frames[partners] - frames[anchors]
+    f_diff = freqs[partners] - freqs[anchors]
+    valid = in_range \
+        & (hash_time_delta_min <= t_diff) & (t_diff <= hash_time_delta_max) \
+        & (np.abs(f_diff) <= freq_margin)
 
-    frames = time
-    frequencies = freq
-    print("Number of peaks found: " + str(len(frames)))
+    # np.nonzero walks the mask row by row, which keeps the original anchor-major order
+    rows, columns = np.nonzero(valid)
 
-    return frames, frequencies
+    return rows, partners[rows, columns]
 
+def detect_peaks(spec, amp_min=peak_amp_min, max_per_frame=peak_max_per_frame):
+    """
+    Take a spectrogram and compute local peaks. A peak is the maximum of the square neighbourhood of
+    2 * peak_neighbourhood_size + 1 bins and frames around it (clipped at the spectrogram borders). Peaks on the
+    outermost bins and frames are ignored. This gives the same peaks as skimage's peak_local_max with that footprint
+    :param spec: The spectrogram (frequency bins x frames)
+    :param amp_min: Optional amplitude floor, peaks must be above it
+    :param max_per_frame: Optional maximum number of peaks per frame, the strongest ones are kept
+    :return: The frames and frequency bins of the peaks, ordered by decreasing intensity
+    """
+    size = 2 * peak_neighbourhood_size + 1
+
+    # Separable max-filter, first pass: maximum over the neighbouring frames of each bin
+    time_max = maximum_filter1d(spec, size, axis=1, mode='nearest')
+
+    # Only bins that are the maximum along time can be peaks
+    threshold = spec.min() if amp_min is None else max(spec.min(), amp_min)
+    candidates = (spec == time_max) & (spec > threshold)
+    candidates[[0, -1], :] = False
+    candidates[:, [0, -1]] = False
+    freqs, frames = np.nonzero(candidates)
+    values = spec[freqs, frames]
+
+    # Second pass, evaluated for the candidates only: maximum over the neighbouring bins
+    padded = np.full((spec.shape[0] + size - 1, spec.shape[1]), -np.inf, dtype=time_max.dtype)
+    padded[peak_neighbourhood_size:peak_neighbourhood_size + spec.shape[0]] = time_max
+    windows = np.lib.stride_tricks.sliding_window_view(padded, size, axis=0)
+    is_peak = windows[freqs, frames].max(axis=1) <= values
+    freqs, frames, values = freqs[is_peak], frames[is_peak], values[is_peak]
+
+    # Highest peak first
+    order = np.argsort(-values, kind="stable")
+    frames = frames[order]
+    frequencies = freqs[order]
+
+    if max_per_frame is not None:
+        # Rank of each peak within its frame (peaks are already sorted by intensity)
+        by_frame = np.argsort(frames, kind="stable")
+        sorted_frames = frames[by_frame]
+        first = np.searchsorted(sorted_frames, sorted_frames)
+        rank = np.empty(frames.size, dtype=np.int64)
+        rank[by_frame] = np.arange(frames.size) - first
+        frames = frames[rank < max_per_frame]
+        frequencies = frequencies[rank < max_per_frame]
+
+    Instrumentation.count("peaks", len(frames))
+
+    return frames, frequencies
@@ -0,0 +1,396 @@
+import os
+import shutil
+
+import numpy as np
+
+import Instrumentation
+import Postings
+import Utility
+from Fingerprint import key_dtype
+
+# Arrays making up an index, each one is stored as '<name>.npy' in the index folder
+index_arrays = ("keys", "pointers", "song_ids", "offsets")
+
+# File storing the song id to name map. Removed songs keep their id, their name is set to ""
+names_file = "ids_names.npy"
+
+# File storing size, modification time and content digest of each song file, used to detect changed files
+catalog_file = "catalog.npy"
+catalog_dtype = np.dtype([("size", np.int64), ("mtime", np.int64), ("digest", "U40")])
+
+# Folder holding the index segments and file listing the segments that make up the index
+segments_folder = "segments"
+manifest_file = "segments.npy"
+
+# Segments are merged into one when an update would leave more than this number of segments
+max_segments = 16
+
+# Stop-list: keys with more postings than this are dropped when the segments are compacted (e.g. hashes of silence,
+# hum or sustained tones, which match nearly every song and carry almost no information). None keeps all keys
+build_max_postings = None
+
+# File storing the keys dropped by the stop-list. Segments appended later may still hold postings of these keys, they
+# are ignored on lookup, so a key is dropped from all segments alike
+stop_list_file = "stopped_keys.npy"
+
+# Save new segments with compressed posting lists (see Postings.py): about a third of the size on disk and in the page
+# cache, at the cost of decoding the touched blocks on every lookup. Lookups become about 15x slower per query (e.g.
+# 0.075 -> 1.1 ms, or 0.13 -> 1.8 ms on the 30-track benchmark), so keep it off for latency-sensitive deployments and
+# measure with Benchmark.py (posting_compression) first. Both formats can be mixed within an index
+compress_postings = False
+
+
+class FingerprintIndex:
+    """
+    Sorted, CSR-style inverted index mapping hash keys to their postings (song_id, offset).
+    The postings of keys[i] are song_ids[pointers[i]:pointers[i + 1]] and offsets[pointers[i]:pointers[i + 1]]
+    """
+
+    def __init__(self, keys, pointers, song_ids, offsets):
+        """
+        :param keys: Sorted array of unique hash keys
+        :param pointers: Start of the posting list of each key, with the total number of postings appended
+        :param song_ids: Song id column of the postings (int32)
+        :param offsets: Offset column of the postings (int32)
+        """
+        self.keys = keys
+        self.pointers = pointers
+        self.song_ids = song_ids
+        self.offsets = offsets
+
+    def __len__(self):
+        return self.keys.size
+
+    def __contains__(self, key):
+        return self._position(key) is not None
+
+    def __getitem__(self, key):
+        """
+        Get the posting list of a key
+        :param key: The hash key
+        :return: An array with one (song_id, offset) row per posting
+        """
+        position = self._position(key)
+        if position is None:
+            raise KeyError(key)
+        start, end = self.pointers[position], self.pointers[position + 1]
+        return np.column_stack((self.song_ids[start:end], self.offsets[start:end]))
+
+    def lookup(self, keys, max_postings=None):
+        """
+        Find the postings of many keys at once
+        :param keys: Array of hash keys
+        :param max_postings: Keys with more postings than this are skipped. None returns the postings of all keys
+        :return: Three arrays with one entry per posting found: the position of the matched key in keys, the song id
+        and the offset of the posting
+        """
+        return Postings.lookup(self.keys, self.pointers, self.song_ids, self.offsets, keys, max_postings)
+
+    def lengths(self, keys):
+        """
+        :param keys: Array of hash keys
+        :return: The number of postings of each key, 0 for keys not in the index
+        """
+        return Postings.lengths(self.keys, self.pointers, keys)
+
+    def _position(self, key):
+        position = np.searchsorted(self.keys, key)
+        if position == self.keys.size or self.keys[position] != key:
+            return None
+        return position
+
+
+class SegmentedIndex:
+    """
+    Index made up of several FingerprintIndex segments, each one covering a distinct set of song ids.
+    Postings of removed songs stay in their segment until the next compaction and are filtered out on lookup
+    """
+
+    def __init__(self, segments, alive, stopped=None):
+        """
+        :param segments: List of FingerprintIndex segments
+        :param alive: Boolean array, True for every song id that is part of the catalog
+        :param stopped: Optional sorted array of keys dropped by the stop-list, ignored in all segments
+        """
+        self.segments = segments
+        self.alive = alive
+        self.stopped = stopped if stopped is not None else np.empty(0, dtype=key_dtype)
+
+    def lookup(self, keys, max_postings=None):
+        """
+        Find the postings of many keys at once, see FingerprintIndex.lookup. max_postings applies to the number of
+        postings of a key in all segments together (including postings of removed songs until the next compaction)
+        """
+        keys = np.asarray(keys)
+        selected = np.arange(keys.size)
+        if self.stopped.size > 0:
+            selected = selected[~np.isin(keys, self.stopped)]
+        if max_postings is not None:
+            # Skip keys which are too frequent to be informative
+            lengths = np.zeros(selected.size, dtype=np.int64)
+            for segment in self.segments:
+                lengths += segment.lengths(keys[selected])
+            keep = lengths <= max_postings
+            Instrumentation.count("stopped_query_keys", int(np.count_nonzero(~keep)))
+            selected = selected[keep]
+
+        results = [segment.lookup(keys[selected]) for segment in self.segments]
+        query_idx, song_ids, offsets = [np.concatenate([np.empty(0, dtype=dtype)] + [result[i] for result in results])
+                                        for i, dtype in enumerate((np.int64, np.int32, np.int32))]
+        query_idx = selected[query_idx]
+
+        # Drop postings of removed songs
+        keep = song_ids < self.alive.size
+        keep[keep] = self.alive[song_ids[keep]]
+
+        return query_idx[keep], song_ids[keep], offsets[keep]
+
+
+def build(song_keys, song_offsets, first_song_id=0, max_postings=None):
+    """
+    Build an index from the fingerprints of all songs
+    :param song_keys: List of hash key arrays, the position in the list (plus first_song_id) is the song id
+    :param song_offsets: List of offset arrays matching song_keys
+    :param first_song_id: The song id of the first song in the lists
+    :param max_postings: Keys with more postings than this are dropped. None keeps all keys. Segments appended to a
+    database keep all keys, the stop-list is applied to the merged posting lists by compact()
+    :return: The FingerprintIndex
+    """
+    lengths = np.array([keys.size for keys in song_keys], dtype=np.int64)
+    keys = np.concatenate([np.empty(0, dtype=key_dtype)] + list(song_keys)).astype(key_dtype)
+    offsets = np.concatenate([np.empty(0, dtype=np.int32)] + list(song_offsets)).astype(np.int32)
+    song_ids = np.repeat(np.arange(first_song_id, first_song_id + lengths.size, dtype=np.int32), lengths)
+
+    return from_postings(keys, song_ids, offsets, max_postings)
+
+
+def from_postings(keys, song_ids, offsets, max_postings=None):
+    """
+    Build an index from flat posting columns
+    :param keys: Hash key of each posting
+    :param song_ids: Song id of each posting
+    :param offsets: Offset of each posting
+    :param max_postings: Keys with more postings than this are dropped. None keeps all keys
+    :return: The FingerprintIndex
+    """
+    # Stable sort keeps the postings of each key in their original (song id) order
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    song_ids = song_ids[order]
+    offsets = offsets[order]
+
+    unique_keys, starts, lengths = np.unique(keys, return_index=True, return_counts=True)
+
+    if max_postings is not None:
+        # Stop-list: drop the keys with the longest posting lists and their postings
+        stopped = lengths > max_postings
+        if stopped.any():
+            keep = ~np.repeat(stopped, lengths)
+            song_ids = song_ids[keep]
+            offsets = offsets[keep]
+            unique_keys = unique_keys[~stopped]
+            lengths = lengths[~stopped]
+            starts = np.cumsum(lengths) - lengths
+            Instrumentation.count("stopped_build_keys", int(np.count_nonzero(stopped)))
+            Instrumentation.log("Stop-list: dropped " + str(np.count_nonzero(stopped)) + " keys with more than "
+                                + str(max_postings) + " postings")
+
+    pointers = np.append(starts, song_ids.size).astype(np.int64)
+
+    return FingerprintIndex(unique_keys, pointers, song_ids, offsets)
+
+
+def posting_stats(index):
+    """
+    Statistics of the posting list lengths of an index
+    :param index: The FingerprintIndex or SegmentedIndex (lengths are per segment)
+    :return: Dict with the number of keys and postings, the mean, median, 90th/99th/99.9th percentile and maximum
+    posting list length and the share of all postings held by the longest 1% of the lists
+    """
+    segments = index.segments if isinstance(index, SegmentedIndex) else [index]
+    lengths = np.concatenate([np.empty(0, dtype=np.int64)] + [np.diff(segment.pointers) for segment in segments])
+    if lengths.size == 0:
+        return {"keys": 0, "postings": 0}
+
+    top = np.sort(lengths)[-max(1, lengths.size // 100):]
+    return {"keys": int(lengths.size),
+            "postings": int(lengths.sum()),
+            "mean": float(lengths.mean()),
+            "p50": float(np.percentile(lengths, 50)),
+            "p90": float(np.percentile(lengths, 90)),
+            "p99": float(np.percentile(lengths, 99)),
+            "p999": float(np.percentile(lengths, 99.9)),
+            "max": int(lengths.max()),
+            "top1_share": float(top.sum() / lengths.sum())}
+
+
+def save_segment(index, folder):
+    """
+    Save a single index segment as plain *.npy files, compressed if compress_postings is set
+    :param index: The FingerprintIndex
+    :param folder: The folder to save the segment to. It is created if it does not exist
+    :return: None
+    """
+    if compress_postings:
+        Postings.save(Postings.compress(index), folder)
+        return
+    os.makedirs(folder, exist_ok=True)
+    for name in index_arrays:
+        np.save(folder + os.path.sep + name + ".npy", getattr(index, name))
+
+
+def load_segment(folder, mmap=True):
+    """
+    Load a segment saved with save_segment()
+    :param folder: The folder containing the segment files
+    :param mmap: If True, the arrays are memory-mapped read-only instead of being read into memory. Loading is then
+    near-instant and all processes using the same index share the OS page cache
+    :return: The FingerprintIndex, or the Postings.CompressedIndex for a compressed segment
+    """
+    if Postings.is_compressed(folder):
+        return Postings.load(folder, mmap)
+    mmap_mode = "r" if mmap else None
+    return FingerprintIndex(*[np.load(folder + os.path.sep + name + ".npy", mmap_mode=mmap_mode)
+                              for name in index_arrays])
+
+
+def load(folder, mmap=True):
+    """
+    Load the index of a fingerprint database
+    :param folder: The fingerprint database folder
+    :param mmap: If True, the index is memory-mapped read-only, see load_segment()
+    :return: The SegmentedIndex
+    """
+    segments = [load_segment(segment_path(folder, number), mmap) for number in load_manifest(folder)]
+    alive = np.asarray(load_names(folder, mmap)) != ""
+    return SegmentedIndex(segments, alive, load_stop_list(folder))
+
+
+def append(index, folder):
+    """
+    Add a segment to the index of a fingerprint database. The songs in the segment must have new song ids
+    :param index: The FingerprintIndex holding the new songs
+    :param folder: The fingerprint database folder
+    :return: None
+    """
+    manifest = load_manifest(folder)
+    number = manifest.max() + 1 if manifest.size > 0 else 0
+    save_segment(index, segment_path(folder, number))
+    Utility.save_atomic(folder + os.path.sep + manifest_file, np.append(manifest, number))
+
+
+def compact(folder, max_postings=build_max_postings):
+    """
+    Merge all segments of a fingerprint database into one and drop the postings of removed songs. The stop-list is
+    applied to the merged posting lists: keys with more postings than max_postings over the whole catalog are added to
+    the stop-list of the database and dropped. Stopped keys stay stopped, their later postings are never counted again
+    :param folder: The fingerprint database folder
+    :param max_postings: Keys with more postings than this are stopped. None stops no further keys
+    :return: None
+    """
+    manifest = load_manifest(folder)
+    database = load(folder, mmap=False)
+    keys = np.concatenate([np.empty(0, dtype=key_dtype)]
+                          + [np.repeat(segment.keys, np.diff(segment.pointers)) for segment in database.segments])
+    song_ids = np.concatenate([np.empty(0, dtype=np.int32)] + [segment.song_ids for segment in database.segments])
+    offsets = np.concatenate([np.empty(0, dtype=np.int32)] + [segment.offsets for segment in database.segments])
+
+    keep = song_ids < database.alive.size
+    keep[keep] = database.alive[song_ids[keep]]
+
+    stopped = database.stopped
+    if max_postings is not None:
+        unique_keys, lengths = np.unique(keys[keep], return_counts=True)
+        new_stopped = unique_keys[lengths > max_postings]
+        Instrumentation.count("stopped_build_keys", int(new_stopped.size))
+        Instrumentation.log("Stop-list: dropped " + str(new_stopped.size) + " keys with more than "
+                            + str(max_postings) + " postings")
+        stopped = np.union1d(stopped, new_stopped).astype(key_dtype)
+    if stopped.size > 0:
+        keep &= ~np.isin(keys, stopped)
+
+    # Segments hold increasing song ids, so the merged postings of each key stay ordered by song id
+    number = manifest.max() + 1 if manifest.size > 0 else 0
+    save_segment(from_postings(keys[keep], song_ids[keep], offsets[keep]), segment_path(folder, number))
+    # The stop-list is saved before the manifest, so the old segments are never read without it
+    Utility.save_atomic(folder + os.path.sep + stop_list_file, stopped)
+    Utility.save_atomic(folder + os.path.sep + manifest_file, np.array([number]))
+
+    for old in manifest:
+        shutil.rmtree(segment_path(folder, old))
+
+
+def segment_path(folder, number):
+    return folder + os.path.sep + segments_folder + os.path.sep + "%06d" % number
+
+
+def load_stop_list(folder):
+    """
+    Load the keys dropped by the stop-list of a fingerprint database
+    :param folder: The fingerprint database folder
+    :return: Sorted array of keys, empty if no key was stopped yet
+    """
+    if not os.path.exists(folder + os.path.sep + stop_list_file):
+        return np.empty(0, dtype=key_dtype)
+    return np.load(folder + os.path.sep + stop_list_file)
+
+
+def load_manifest(folder):
+    """
+    Load the numbers of the segments making up the index of a fingerprint database
+    :param folder: The fingerprint database folder
+    :return: Array of segment numbers, empty if there is no index yet
+    """
+    if not os.path.exists(folder + os.path.sep + manifest_file):
+        return np.empty(0, dtype=np.int64)
+    return np.load(folder + os.path.sep + manifest_file)
+
+
+def save_names(ids_names, folder):
+    """
+    Save the song id to name map
+    :param ids_names: Sequence of song names, the position is the song id
+    :param folder: The folder to save the map to
+    :return: None
+    """
+    Utility.save_atomic(folder + os.path.sep + names_file, np.array(ids_names, dtype=np.str_))
+
+
+def load_names(folder, mmap=True):
+    """
+    Load the song id to name map saved with save_names()
+    :param folder: The folder containing the map
+    :param mmap: If True, the map is memory-mapped read-only
+    :return: Array of song names indexed by song id
+    """
+    return np.load(folder + os.path.sep + names_file, mmap_mode="r" if mmap else None)
+
+
+def save_catalog(catalog, folder):
+    """
+    Save the file signatures of all songs
+    :param catalog: Array of catalog_dtype, the position is the song id
+    :param folder: The fingerprint database folder
+    :return: None
+    """
+    Utility.save_atomic(folder + os.path.sep + catalog_file, np.asarray(catalog, dtype=catalog_dtype))
+
+
+def load_catalog(folder):
+    """
+    Load the file signatures saved with save_catalog()
+    :param folder: The fingerprint database folder
+    :return: Array of catalog_dtype indexed by song id, empty if there is no catalog yet
+    """
+    if not os.path.exists(folder + os.path.sep + catalog_file):
+        return np.empty(0, dtype=catalog_dtype)
+    return np.load(folder + os.path.sep + catalog_file)
+
+
+def exists(folder):
+    """
+    Check whether a folder contains a fingerprint database (index and song id to name map)
+    :param folder: The folder
+    :return: True if the database files are present
+    """
+    return os.path.exists(folder + os.path.sep + manifest_file) and os.path.exists(folder + os.path.sep + names_file)
@@ -0,0 +1,171 @@
+import contextlib
+import cProfile
+import json
+import os
+import time
+
+# Environment variables switching instrumentation, per-file diagnostic output and profiling on
+# (e.g. AUDIO_ID_INSTRUMENT=1, AUDIO_ID_VERBOSE=1, AUDIO_ID_PROFILE=profile.out)
+instrument_env = "AUDIO_ID_INSTRUMENT"
+verbose_env = "AUDIO_ID_VERBOSE"
+profile_env = "AUDIO_ID_PROFILE"
+
+# Prefix of the metric names in the Prometheus export
+metric_prefix = "audio_id"
+
+# Timers and counters are only recorded while enabled. When disabled, timer() returns a shared no-op context manager
+# and count() / observe() return immediately
+enabled = os.environ.get(instrument_env, "") not in ("", "0")
+# Per-file diagnostics (peaks and hashes found, correct matches) are only printed while verbose
+verbose = os.environ.get(verbose_env, "") not in ("", "0")
+
+# Counters of the current process: name -> value
+counters = {}
+# Observations (stage durations in seconds, sizes per query) of the current process: name -> [count, sum, max]
+summaries = {}
+
+_disabled_timer = contextlib.nullcontext()
+
+
+class Timer:
+    """
+    Context manager adding the duration of its block to the "<name>_seconds" summary
+    """
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name + "_seconds"
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def enable(on=True):
+    """
+    Switch recording of timers and counters on or off
+    :param on: True to record
+    :return: None
+    """
+    global enabled
+    enabled = on
+
+
+def timer(name):
+    """
+    Time a pipeline stage: with Instrumentation.timer("stft"): ...
+    :param name: The stage name
+    :return: The context manager
+    """
+    if not enabled:
+        return _disabled_timer
+    return Timer(name)
+
+
+def count(name, value=1):
+    """
+    Add to a counter
+    :param name: The counter name
+    :param value: The amount to add
+    :return: None
+    """
+    if enabled:
+        counters[name] = counters.get(name, 0) + value
+
+
+def observe(name, value):
+    """
+    Record one observation of a quantity, e.g. the number of hashes of a query
+    :param name: The quantity name
+    :param value: The observed value
+    :return: None
+    """
+    if not enabled:
+        return
+    summary = summaries.get(name)
+    if summary is None:
+        summaries[name] = [1, value, value]
+    else:
+        summary[0] += 1
+        summary[1] += value
+        summary[2] = max(summary[2], value)
+
+
+def log(message):
+    """
+    Print a per-file diagnostic message, only if verbose
+    :param message: The message
+    :return: None
+    """
+    if verbose:
+        print(message)
+
+
+def reset():
+    """
+    Clear all timers and counters
+    :return: None
+    """
+    counters.clear()
+    summaries.clear()
+
+
+def snapshot():
+    """
+    :return: Dict with the counters and, per summary, the count, sum, mean and max of its observations
+    """
+    return {"counters": dict(counters),
+            "summaries": {name: {"count": n, "sum": total, "mean": total / n, "max": maximum}
+                          for name, (n, total, maximum) in summaries.items()}}
+
+
+def to_json():
+    """
+    :return: The snapshot() as JSON text
+    """
+    return json.dumps(snapshot(), indent=2, sort_keys=True)
+
+
+def to_prometheus():
+    """
+    Export all timers and counters in the Prometheus text exposition format
+    :return: The exposition text
+    """
+    lines = []
+    for name, value in sorted(counters.items()):
+        metric = metric_prefix + "_" + name + "_total"
+        lines.append("# TYPE " + metric + " counter")
+        lines.append(metric + " " + repr(float(value)))
+    for name, (n, total, _) in sorted(summaries.items()):
+        metric = metric_prefix + "_" + name
+        lines.append("# TYPE " + metric + " summary")
+        lines.append(metric + "_count " + repr(float(n)))
+        lines.append(metric + "_sum " + repr(float(total)))
+    return "\n".join(lines) + "\n"
+
+
+@contextlib.contextmanager
+def profile(path=None):
+    """
+    Profile a block with cProfile: with Instrumentation.profile("identify.prof"): ... The stats file can be read with
+    pstats or snakeviz. Stages are plain named functions, so sampling profilers (py-spy) attribute time to them as well
+    :param path: The file to write the stats to. None uses the file named by the AUDIO_ID_PROFILE environment variable
+    and does not profile if it is not set
+    :return: The context manager
+    """
+    path = path if path is not None else os.environ.get(profile_env)
+    if not path:
+        yield None
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -1,17 +1,56 @@
 import os
-import pickle
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import numpy as np
+
 import Database
 import Fingerprint
+import Index
+import Instrumentation
+import Pipeline
+import Utility
+
+# Maximum number of queries submitted to each query worker but not yet consumed. Bounds the memory held by pending
+# queries and results for large query sets
+queries_in_flight_per_worker = 4
 
 
-def fingerprintBuilder(path_to_db, path_to_fingerprints):
+def fingerprintBuilder(path_to_db, path_to_fingerprints, workers=1):
     """
     Creates fingerprints of all files specified in path_to_db
     :param path_to_db: The path to the database files
     :param path_to_fingerprints: The folder where fingerprints will be generated. If this folder does not yet exist
     it will be auto-generated
+    :param workers: Number of processes fingerprinting files in parallel. None uses one process per CPU core
+    :return: None
+    """
+    # Don't generate fingerprint database if it already exists
+    if Index.exists(path_to_fingerprints):
+        print("Fingerprint database was already generated. It is located in " + path_to_fingerprints)
+        print("Aborting database fingerprint generation")
+        print("Use fingerprintUpdater to bring it in line with the database files. If you want to re-generate the "
+              "database on purpose, delete the folder.")
+        return
+
+    fingerprintUpdater(path_to_db, path_to_fingerprints, workers)
+
+    # The stop-list is applied to the merged posting lists when compacting
+    if Index.build_max_postings is not None and Index.load_manifest(path_to_fingerprints).size == 1:
+        Index.compact(path_to_fingerprints)
+
+def fingerprintUpdater(path_to_db, path_to_fingerprints, workers=1):
+    """
+    Updates the fingerprint database to match the files in path_to_db. New files are fingerprinted and appended to the
+    index as a new segment, fingerprints of removed files are dropped and changed files (detected by size and
+    modification time, confirmed by content digest) are re-fingerprinted under a new song id. Unchanged files keep
+    their song id. Creates the database if it does not exist yet
+    :param path_to_db: The path to the database files
+    :param path_to_fingerprints: The folder where fingerprints are stored. If this folder does not yet exist
+    it will be auto-generated
+    :param workers: Number of processes fingerprinting files in parallel. None uses one process per CPU core. Files are
+    read ahead by a thread pool while others are fingerprinted, see Pipeline.run()
     :return: None
     """
     # Check if path to db is valid
@@ -19,113 +58,206 @@ def fingerprintBuilder(path_to_db, path_to_fingerprints):
         print("Path to db files does not exist / is invalid. Aborting...")
         return
 
-    # Create folder for saved spectrograms if not exists
+    # Create folder for fingerprints if not exists
     if not os.path.exists(path_to_fingerprints):
         Path(path_to_fingerprints).mkdir(parents=True, exist_ok=True)
 
-    # Don't generate fingerprint database if it already exists
-    if os.path.exists(path_to_fingerprints + os.path.sep + 'db_S.pkl') \
-            and os.path.exists(path_to_fingerprints + os.path.sep + 'ids_names.pkl'):
-        print("Fingerprint database was already generated. It is located in " + path_to_fingerprints)
-        print("Aborting database fingerprint generation")
-        print("If you want to re-generate the database on purpose, delete the 'db_S.pkl' and 'ids_names.pkl' files.")
-        return
+    # Load id to name map and file signatures of the current database
+    if Index.exists(path_to_fingerprints):
+        ids_names = [str(name) for name in Index.load_names(path_to_fingerprints, mmap=False)]
+        catalog = Index.load_catalog(path_to_fingerprints)
+    else:
+        ids_names = []
+        catalog = np.empty(0, dtype=Index.catalog_dtype)
+    # Songs without a stored signature are treated as changed
+    catalog = np.append(catalog, np.zeros(len(ids_names) - catalog.size, dtype=Index.catalog_dtype))
+    known = {name: song_id for song_id, name in enumerate(ids_names) if name != ""}
+
+    # Get all wav files in db folder, sorted so that new song ids don't depend on the file system order
+    wavs = sorted(Path(path_to_db).rglob("*.wav"))
 
-    # Initialise database and id to name map objects
-    database = {}
-    ids_names = {}
+    new_wavs = []
+    new_stats = []
+    changed = 0
+    for wav in wavs:
+        stat = wav.stat()
+        song_id = known.pop(str(wav), None)
+        if song_id is not None and catalog[song_id]["size"] == stat.st_size \
+                and catalog[song_id]["mtime"] == stat.st_mtime_ns:
+            continue
 
-    # Get all wav files in db folder
-    wavs = Path(path_to_db).rglob("*.wav")
+        if song_id is not None:
+            digest = Utility.file_digest(wav)
+            if catalog[song_id]["digest"] == digest:
+                # File was touched but its content is unchanged
+                catalog[song_id] = (stat.st_size, stat.st_mtime_ns, digest)
+                continue
+            # Drop the outdated fingerprints, the file is fingerprinted again below
+            ids_names[song_id] = ""
+            changed += 1
 
-    # Get number of files in folder (this invalidates the pathlib object)
-    number_of_db_files = sum(1 for x in wavs)
+        # The digest of new files is computed when the pipeline reads them
+        new_wavs.append(wav)
+        new_stats.append((stat.st_size, stat.st_mtime_ns))
 
-    # Reset pathlib object
-    wavs = Path(path_to_db).rglob("*.wav")
+    # Files which are no longer in the db folder
+    for song_id in known.values():
+        ids_names[song_id] = ""
 
-    counter = 0
-    for wav in wavs:
-        print("Generating fingerprint " + str(counter) + " / " + str(number_of_db_files))
-        song_id = counter
-        hashes = Fingerprint.compute_fingerprint(wav)
-        for h, offset in hashes:
-            digest = h.digest()
-            if digest in database:
-                database[digest].append((song_id, offset))
-            else:
-                database[digest] = [(song_id, offset)]
-
-        # Associate id to name
-        ids_names[song_id] = str(wav)
-        counter += 1
-
-    with open(path_to_fingerprints + os.path.sep + 'db_S.pkl', 'wb') as f:
-        pickle.dump(database, f, pickle.HIGHEST_PROTOCOL)
-        print("Database saved to file 'db_S.pkl' in folder " + str(path_to_fingerprints))
-
-        # Save name ids dict
-    with open(path_to_fingerprints + os.path.sep + 'ids_names.pkl', 'wb') as f:
-        pickle.dump(ids_names, f, pickle.HIGHEST_PROTOCOL)
-        print("Song ID to song name map 'ids_names.pkl' saved in folder " + str(path_to_fingerprints))
+    print("New files: " + str(len(new_wavs) - changed) + ", changed files: " + str(changed)
+          + ", removed files: " + str(len(known)))
+
+    if len(new_wavs) > 0:
+        # Initialise per-song fingerprints
+        song_keys = []
+        song_offsets = []
+        new_signatures = []
+
+        def write(wav, digest, fingerprint):
+            keys, offsets = fingerprint
+            Instrumentation.log("Generated fingerprint " + str(len(song_keys) + 1) + " / " + str(len(new_wavs)))
+            song_keys.append(keys)
+            song_offsets.append(offsets)
+            new_signatures.append(new_stats[len(new_signatures)] + (digest,))
+
+        # Reading, fingerprinting and collecting the files overlap
+        with Instrumentation.profile():
+            Pipeline.run(new_wavs, write, workers)
+        print("Pipeline timings: " + Pipeline.summary())
+        if Instrumentation.enabled:
+            print("Instrumentation: " + Instrumentation.to_json())
+
+        # Reserve the song ids of the new songs before their segment goes live: the names stay empty (removed) until
+        # the segment is saved, so after a crash in between the ids are not given out again and the orphaned
+        # postings are dropped by the next compaction
+        first_song_id = len(ids_names)
+        Index.save_names(ids_names + [""] * len(new_wavs), path_to_fingerprints)
+        Index.save_catalog(np.append(catalog, np.zeros(len(new_wavs), dtype=Index.catalog_dtype)),
+                           path_to_fingerprints)
+
+        # Build an index segment for the new songs and append it to the database
+        segment = Index.build(song_keys, song_offsets, first_song_id=first_song_id)
+        Index.append(segment, path_to_fingerprints)
+        print("Database index segment saved to folder " + str(path_to_fingerprints))
+        print("Posting list lengths of the segment: " + str(Index.posting_stats(segment)))
+
+        # Associate ids to names
+        ids_names.extend(str(wav) for wav in new_wavs)
+        catalog = np.append(catalog, np.array(new_signatures, dtype=Index.catalog_dtype))
+
+    # Save song id to name map (this also commits removals) and file signatures
+    Index.save_names(ids_names, path_to_fingerprints)
+    Index.save_catalog(catalog, path_to_fingerprints)
+    print("Song ID to song name map '" + Index.names_file + "' saved in folder " + str(path_to_fingerprints))
+
+    if Index.load_manifest(path_to_fingerprints).size > Index.max_segments:
+        print("Compacting index segments")
+        Index.compact(path_to_fingerprints)
 
     print("Done generating fingerprints")
 
-def audioIdentification(path_to_queryset, path_to_fingerprints, path_to_output_txt):
+def audioIdentification(path_to_queryset, path_to_fingerprints, path_to_output_txt, workers=1):
     """
     This function performs audio identification for each element in a query set against a database of fingerprints
     :param path_to_queryset: The path (absolute or relative) to the queryset -> *.wav files
     :param path_to_fingerprints: The path to the fingerprints. NB: This should only point to the containing FOLDER,
-    not the serialised 'db_S.pkl' file itself.
+    not the index '*.npy' files themselves.
     :param path_to_output_txt: Path to the output file. A new file is generated if it does not yet exists.
+    :param workers: Number of processes identifying queries in parallel. None uses one process per CPU core. All
+    processes memory-map the same index. Results are written in input order. Timers and counters (see Instrumentation)
+    are recorded per process, so only workers=1 reports them
     :return: None
     """
-    if not os.path.exists(path_to_fingerprints) or not os.path.exists(path_to_fingerprints + os.path.sep + "db_S.pkl"):
+    if not os.path.exists(path_to_fingerprints) or not Index.exists(path_to_fingerprints):
         print("Path to fingerprint database does not exist / is invalid. Aborting...")
         return
 
-    # Load database from file
-    db_file = open(path_to_fingerprints + os.path.sep + "db_S.pkl", "rb")
-    ids_names_file = open(path_to_fingerprints + os.path.sep + "ids_names.pkl", "rb")
-    database = pickle.load(db_file)
-    ids_names = pickle.load(ids_names_file)
-
-    # Clear txt
-    txt_file = open(path_to_output_txt, 'w+')
-
-    # Get all wavs in query folder
-    query_wavs = Path(path_to_queryset).rglob("*.wav")
-
-    # Get number of files in folder (this invalidates the pathlib object)
-    number_of_query_files = sum(1 for x in query_wavs)
+    # Get all wavs in query folder, sorted so that the output order doesn't depend on the file system order
+    query_wavs = [str(wav) for wav in sorted(Path(path_to_queryset).rglob("*.wav"))]
 
-    # Reload the wavs (because object is invalidated after counting)
-    query_wavs = Path(path_to_queryset).rglob("*.wav")
+    # Get number of files in folder
+    number_of_query_files = len(query_wavs)
 
     wrong_files = []
     correct = 0
     counter = 0
-    for wav in query_wavs:
-        best_three, is_correct = analyse(database, ids_names, str(wav))
-        correct += 1 if is_correct else 0
-        if not is_correct:
-            wrong_files.append(str(wav))
+    # Clear txt
+    with open(path_to_output_txt, 'w+') as txt_file, Instrumentation.profile():
+        for wav, (best_three, is_correct) in zip(query_wavs, analyse_all(query_wavs, path_to_fingerprints, workers)):
+            correct += 1 if is_correct else 0
+            if not is_correct:
+                wrong_files.append(wav)
 
-        # Write query filename and three resulting filenames to txt
-        query_filename = str(wav).split(os.path.sep)[-1]
-        txt_file.write(query_filename + '\t')
-        for result in best_three:
-            filename = result.split(os.path.sep)[-1]
-            txt_file.write(filename + '\t')
+            # Write query filename and three resulting filenames to txt
+            query_filename = wav.split(os.path.sep)[-1]
+            txt_file.write(query_filename + '\t')
+            for result in best_three:
+                filename = result.split(os.path.sep)[-1]
+                txt_file.write(filename + '\t')
 
-        # Newline
-        txt_file.write("\n")
+            # Newline
+            txt_file.write("\n")
 
-        counter += 1
+            counter += 1
 
-    print("Done processing. Correct: " + str(round(100 * correct / number_of_query_files, 2)) + "%.")
+    print("Done processing. Correct: " + str(round(100 * correct / max(number_of_query_files, 1), 2)) + "%.")
+    if Instrumentation.enabled:
+        print("Instrumentation: " + Instrumentation.to_json())
     # print("Wrong files: " + ", ".join(wrong_files))
 
+# Database and ID to name map of a query worker process, loaded once by init_query_worker
+worker_database = None
+worker_ids_names = None
+
+def init_query_worker(path_to_fingerprints):
+    """
+    Memory-map the database in a query worker process
+    :param path_to_fingerprints: The path to the fingerprints folder
+    :return: None
+    """
+    global worker_database, worker_ids_names
+    worker_database = Index.load(path_to_fingerprints)
+    worker_ids_names = Index.load_names(path_to_fingerprints)
+
+def analyse_in_worker(path):
+    """
+    Analyse a file against the database of the current query worker process
+    :param path: The path to the *.wav file to be analysed
+    :return: See analyse()
+    """
+    return analyse(worker_database, worker_ids_names, path)
+
+def analyse_all(paths, path_to_fingerprints, workers=1):
+    """
+    Analyse many files, optionally in parallel
+    :param paths: List of paths to *.wav files
+    :param path_to_fingerprints: The path to the fingerprints folder
+    :param workers: Number of worker processes. 1 analyses the files in the current process, None uses one process
+    per CPU core
+    :return: Generator yielding the result of analyse() for each file in the order of paths
+    """
+    if workers == 1:
+        init_query_worker(path_to_fingerprints)
+        yield from map(analyse_in_worker, paths)
+        return
+
+    # Each worker memory-maps the index once, the mapped pages are shared through the OS page cache
+    in_flight = queries_in_flight_per_worker * (workers if workers is not None else os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_query_worker,
+                             initargs=(path_to_fingerprints,)) as executor:
+        # Submit ahead only a bounded window of queries, results are consumed in order
+        paths = iter(paths)
+        pending = deque()
+        while True:
+            while len(pending) < in_flight:
+                path = next(paths, None)
+                if path is None:
+                    break
+                pending.append(executor.submit(analyse_in_worker, path))
+            if not pending:
+                return
+            yield pending.popleft().result()
+
 def analyse(database, ids_names, path):
     """
     Helper function to analyse a given file
@@ -134,10 +266,12 @@ def analyse(database, ids_names, path):
     :param path: The path to the *.wav file to be analysed
     :return: A list of the best three results and a flag indicating whether the top guess was correct
     """
-    # Compute the fingerprint
-    fp_q = Fingerprint.compute_fingerprint(path)
-    # Get results from the database
-    results = Database.search(database, ids_names, fp_q)
+    with Instrumentation.timer("query"):
+        # Compute the fingerprint
+        fp_q = Fingerprint.compute_fingerprint(path)
+        # Get results from the database
+        results = Database.search(database, ids_names, fp_q)
+    Instrumentation.count("queries")
 
     if len(results) == 0:
         return [], False
@@ -147,7 +281,8 @@ def analyse(database, ids_names, path):
     best_result_filename = results[0].split(os.path.sep)[-1][:-4]
     correct = False
     if path_filename == best_result_filename:
-        print("Correct!")
+        Instrumentation.log("Correct!")
+        Instrumentation.count("correct_queries")
         correct = True
 
     return results, correct
@@ -0,0 +1,154 @@
+import hashlib
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from queue import Queue
+from threading import Thread
+
+import Fingerprint
+
+# Number of threads reading files ahead of the fingerprint stage. Reads are I/O bound, so more threads than CPU cores
+# hide the latency of slow (e.g. network) storage
+reader_threads = 8
+
+# Maximum number of files held by each stage (read ahead, being fingerprinted, waiting to be written). A slow stage
+# stalls the stages before it, which bounds the memory used by file contents and fingerprints
+stage_depth = 16
+
+# Seconds spent in each stage during the last run(). "read" and "fingerprint" are summed over all reader threads and
+# fingerprint workers, the "_wait" entries are the seconds the pipeline was blocked waiting for a stage
+timings = {}
+
+
+def run(paths, write, workers=1, readers=reader_threads, depth=stage_depth):
+    """
+    Fingerprint many files in a pipeline of three overlapping stages: a thread pool reading the files, a pool decoding
+    and fingerprinting their content and a writer thread handing the fingerprints to write() in input order
+    :param paths: List of paths to *.wav files
+    :param write: Function called in the writer thread with the path, the SHA-1 digest of the content and the
+    fingerprint (hash keys, offsets) of each file, in the order of paths
+    :param workers: Number of fingerprinting processes. 1 fingerprints in a thread of the current process, None uses
+    one process per CPU core
+    :param readers: Number of reader threads
+    :param depth: Maximum number of files held by each stage
+    :return: None
+    """
+    timings.clear()
+    timings.update({"read": 0.0, "fingerprint": 0.0, "write": 0.0,
+                    "read_wait": 0.0, "fingerprint_wait": 0.0, "write_wait": 0.0, "total": 0.0})
+    start = time.perf_counter()
+
+    written = Queue(maxsize=depth)
+    errors = []
+    writer = Thread(target=write_stage, args=(written, write, errors))
+    writer.start()
+
+    fingerprint_pool = ThreadPoolExecutor(max_workers=1) if workers == 1 else ProcessPoolExecutor(max_workers=workers)
+    try:
+        with ThreadPoolExecutor(max_workers=readers) as read_pool, fingerprint_pool:
+            paths = iter(paths)
+            reads = deque()
+            fingerprints = deque()
+
+            def read_ahead():
+                while len(reads) < depth:
+                    path = next(paths, None)
+                    if path is None:
+                        return
+                    reads.append(read_pool.submit(read, path))
+
+            read_ahead()
+            while reads or fingerprints:
+                # Hand read files to the fingerprint stage while it has room
+                while reads and len(fingerprints) < depth:
+                    path, data, digest = wait(reads.popleft(), "read_wait", "read")
+                    fingerprints.append((path, digest, fingerprint_pool.submit(fingerprint, path, data, digest)))
+                    read_ahead()
+
+                path, digest, future = fingerprints.popleft()
+                fp = wait(future, "fingerprint_wait", "fingerprint")
+                blocked = time.perf_counter()
+                written.put((path, digest, fp))
+                timings["write_wait"] += time.perf_counter() - blocked
+                if errors:
+                    break
+    finally:
+        written.put(None)
+        writer.join()
+        timings["total"] = time.perf_counter() - start
+
+    if errors:
+        raise errors[0]
+
+
+def wait(future, wait_timing, stage_timing):
+    """
+    Wait for the result of a stage and account for the time spent
+    :param future: The future of the stage's task, returning its result and the seconds it took
+    :param wait_timing: The timings entry counting the time blocked on the stage
+    :param stage_timing: The timings entry counting the time spent in the stage
+    :return: The result of the task
+    """
+    blocked = time.perf_counter()
+    result, seconds = future.result()
+    timings[wait_timing] += time.perf_counter() - blocked
+    timings[stage_timing] += seconds
+    return result
+
+
+def read(path):
+    """
+    Read stage: read a file into memory
+    :param path: The path to the file
+    :return: The path, the content and its SHA-1 digest, and the seconds it took
+    """
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha1(data).hexdigest()
+    return (path, data, digest), time.perf_counter() - start
+
+
+def fingerprint(path, data, digest):
+    """
+    Fingerprint stage: decode the content of a file and fingerprint it. Database recordings are fingerprinted again
+    after parameter changes, so their spectrograms are cached
+    :param path: The path to the file
+    :param data: The content of the file
+    :param digest: The SHA-1 digest of the content, computed by the read stage
+    :return: The fingerprint (hash keys, offsets) and the seconds it took
+    """
+    start = time.perf_counter()
+    fp = Fingerprint.compute_fingerprint(path, data, digest, cache=True)
+    return fp, time.perf_counter() - start
+
+
+def write_stage(written, write, errors):
+    """
+    Writer stage: hand the fingerprints to write() until the None marking the end of the pipeline arrives. After an
+    error the remaining fingerprints are dropped, so that the other stages never block on the queue
+    :param written: Queue of (path, digest, fingerprint)
+    :param write: See run()
+    :param errors: List receiving the exception raised by write()
+    :return: None
+    """
+    while True:
+        item = written.get()
+        if item is None:
+            return
+        if errors:
+            continue
+        start = time.perf_counter()
+        try:
+            write(*item)
+        except Exception as error:
+            errors.append(error)
+        timings["write"] += time.perf_counter() - start
+
+
+def summary():
+    """
+    Format the timings of the last run()
+    :return: One line listing the seconds spent in and waiting for each stage
+    """
+    return ", ".join(name + ": " + str(round(seconds, 2)) + "s" for name, seconds in timings.items())
@@ -0,0 +1,366 @@
+import os
+import time
+
+import numpy as np
+
+import Instrumentation
+from Fingerprint import key_dtype
+
+# Number of keys per block. A lookup decodes every block holding one of the query keys, so smaller blocks make lookups
+# faster and the index larger (the first key and the stream positions of each block are stored uncompressed)
+block_keys = 32
+
+# Arrays making up a compressed index segment, each one is stored as '<name>.npy' in the segment folder
+compressed_arrays = ("first_keys", "block_entries", "block_bytes",
+                     "key_stream", "length_stream", "song_stream", "offset_stream")
+
+# Byte streams, in the order of the columns of block_bytes
+streams = ("key_stream", "length_stream", "song_stream", "offset_stream")
+
+
+def lookup(table_keys, pointers, song_ids, offsets, keys, max_postings=None):
+    """
+    Find the postings of many keys at once in CSR posting lists: the postings of table_keys[i] are
+    song_ids[pointers[i]:pointers[i + 1]] and offsets[pointers[i]:pointers[i + 1]]
+    :param table_keys: Sorted array of unique hash keys
+    :param pointers: Start of the posting list of each key, with the total number of postings appended
+    :param song_ids: Song id column of the postings
+    :param offsets: Offset column of the postings
+    :param keys: Array of hash keys to look up
+    :param max_postings: Keys with more postings than this are skipped. None returns the postings of all keys
+    :return: Three arrays with one entry per posting found: the position of the matched key in keys, the song id
+    and the offset of the posting
+    """
+    keys = np.asarray(keys)
+    if table_keys.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+
+    positions = np.minimum(np.searchsorted(table_keys, keys), table_keys.size - 1)
+    found = table_keys[positions] == keys
+    query_idx = np.nonzero(found)[0]
+    positions = positions[found]
+
+    # Expand the [start, end) posting range of every matched key
+    starts = pointers[positions]
+    lengths = pointers[positions + 1] - starts
+    if max_postings is not None:
+        # Skip keys which are too frequent to be informative
+        keep = lengths <= max_postings
+        Instrumentation.count("stopped_query_keys", int(np.count_nonzero(~keep)))
+        query_idx, starts, lengths = query_idx[keep], starts[keep], lengths[keep]
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    postings = np.repeat(starts, lengths) + within
+
+    return np.repeat(query_idx, lengths), song_ids[postings], offsets[postings]
+
+
+def lengths(table_keys, pointers, keys):
+    """
+    Number of postings of many keys in CSR posting lists, see lookup()
+    :param table_keys: Sorted array of unique hash keys
+    :param pointers: Start of the posting list of each key, with the total number of postings appended
+    :param keys: Array of hash keys
+    :return: The number of postings of each key, 0 for keys not in the table
+    """
+    keys = np.asarray(keys)
+    if table_keys.size == 0:
+        return np.zeros(keys.size, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(table_keys, keys), table_keys.size - 1)
+    counts = pointers[positions + 1] - pointers[positions]
+    return np.where(table_keys[positions] == keys, counts, 0)
+
+
+class CompressedIndex:
+    """
+    Posting lists compressed in blocks of block_keys keys. The postings of each key are sorted by song id and offset.
+    Four LEB128 varint byte streams hold, per key, the gap to the previous key of its block and the length of its
+    posting list and, per posting, the song id as gap to the previous posting of the list and the offset as gap to the
+    previous posting of the same song in the list. For each block the first key, the start of the block in every
+    stream and its first key and posting are kept uncompressed, so a lookup only decodes the blocks holding query
+    keys, all of them at once with vectorized NumPy operations.
+    Offers the same lookup() as Index.FingerprintIndex (the postings of a key come sorted by song id and offset).
+    keys, pointers, song_ids and offsets decode the whole segment (once) for the rare operations needing all postings
+    (compaction, statistics, sharding)
+    """
+
+    def __init__(self, first_keys, block_entries, block_bytes, key_stream, length_stream, song_stream,
+                 offset_stream):
+        """
+        :param first_keys: First key of each block
+        :param block_entries: Index of the first key and of the first posting of each block (blocks + 1 x 2), the last
+        row holds the number of keys and postings
+        :param block_bytes: Start of each block in each stream (blocks + 1 x 4), the last row holds the stream sizes
+        :param key_stream: Varint key gaps (0 for the first key of a block)
+        :param length_stream: Varint posting list lengths
+        :param song_stream: Varint song id gaps (the song id itself for the first posting of a list)
+        :param offset_stream: Varint offset gaps (the offset itself for the first posting of a song in a list)
+        """
+        self.first_keys = first_keys
+        self.block_entries = block_entries
+        self.block_bytes = block_bytes
+        self.key_stream = key_stream
+        self.length_stream = length_stream
+        self.song_stream = song_stream
+        self.offset_stream = offset_stream
+        self._decoded = None
+
+    def __len__(self):
+        return int(self.block_entries[-1, 0])
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in compressed_arrays)
+
+    def lookup(self, keys, max_postings=None):
+        """
+        Find the postings of many keys at once, see lookup()
+        """
+        keys = np.asarray(keys)
+        if self.first_keys.size == 0 or keys.size == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+
+        blocks = np.unique(np.maximum(np.searchsorted(self.first_keys, keys, side="right") - 1, 0))
+        return lookup(*decode_blocks(self, blocks), keys, max_postings)
+
+    def lengths(self, keys):
+        """
+        Number of postings of many keys, see lengths()
+        """
+        keys = np.asarray(keys)
+        if self.first_keys.size == 0 or keys.size == 0:
+            return np.zeros(keys.size, dtype=np.int64)
+
+        blocks = np.unique(np.maximum(np.searchsorted(self.first_keys, keys, side="right") - 1, 0))
+        decoded_keys, pointers, _, _ = decode_blocks(self, blocks)
+        return lengths(decoded_keys, pointers, keys)
+
+    def decode(self):
+        """
+        Decode the whole segment
+        :return: The keys, pointers, song ids and offsets, see lookup()
+        """
+        if self._decoded is None:
+            self._decoded = decode_blocks(self, np.arange(self.first_keys.size))
+        return self._decoded
+
+    @property
+    def keys(self):
+        return self.decode()[0]
+
+    @property
+    def pointers(self):
+        return self.decode()[1]
+
+    @property
+    def song_ids(self):
+        return self.decode()[2]
+
+    @property
+    def offsets(self):
+        return self.decode()[3]
+
+
+def compress(index):
+    """
+    Compress the posting lists of an index
+    :param index: The Index.FingerprintIndex
+    :return: The CompressedIndex
+    """
+    keys = np.asarray(index.keys).astype(np.uint64)
+    pointers = np.asarray(index.pointers)
+    lengths = np.diff(pointers)
+
+    # Sort the postings of each key by song id and offset, so both can be stored as small gaps
+    owner = np.repeat(np.arange(keys.size), lengths)
+    song_ids = np.asarray(index.song_ids).astype(np.int64)
+    offsets = np.asarray(index.offsets).astype(np.int64)
+    if np.any(offsets < 0):
+        raise ValueError("Offsets must not be negative")
+    order = np.lexsort((offsets, song_ids, owner))
+    song_ids, offsets = song_ids[order], offsets[order]
+
+    block_starts = np.arange(0, keys.size, block_keys)
+    key_gaps = np.diff(keys, prepend=np.uint64(0))
+    key_gaps[block_starts] = 0
+
+    list_start = np.zeros(song_ids.size, dtype=bool)
+    list_start[pointers[:-1][lengths > 0]] = True
+    song_gaps = np.where(list_start, song_ids, np.diff(song_ids, prepend=0))
+    song_start = list_start | (song_gaps != 0)
+    offset_gaps = np.where(song_start, offsets, np.diff(offsets, prepend=0))
+
+    columns = [(key_gaps, block_starts), (lengths, block_starts),
+               (song_gaps, pointers[block_starts]), (offset_gaps, pointers[block_starts])]
+    encoded = []
+    block_bytes = np.empty((block_starts.size + 1, len(streams)), dtype=np.int64)
+    for column, (values, starts) in enumerate(columns):
+        stream, value_starts = encode_varints(values)
+        encoded.append(stream)
+        block_bytes[:-1, column] = value_starts[starts]
+        block_bytes[-1, column] = stream.size
+
+    block_entries = np.stack((np.append(block_starts, keys.size), np.append(pointers[block_starts], pointers[-1])),
+                             axis=1).astype(np.int64)
+    return CompressedIndex(keys[block_starts].astype(key_dtype), block_entries, block_bytes, *encoded)
+
+
+def decode_blocks(index, blocks):
+    """
+    Decode some blocks of a compressed index
+    :param index: The CompressedIndex
+    :param blocks: Sorted array of block numbers
+    :return: The keys, pointers, song ids and offsets of the blocks, see lookup()
+    """
+    n_keys = index.block_entries[blocks + 1, 0] - index.block_entries[blocks, 0]
+
+    # Keys: prefix sums of the gaps within each block, starting at the first key of the block
+    key_gaps = decode_varints(gather(index.key_stream, index.block_bytes[blocks, 0], index.block_bytes[blocks + 1, 0]))
+    keys = segmented_cumsum(key_gaps, n_keys) + np.repeat(np.asarray(index.first_keys[blocks], dtype=np.uint64), n_keys)
+    lengths = decode_varints(gather(index.length_stream, index.block_bytes[blocks, 1],
+                                    index.block_bytes[blocks + 1, 1])).astype(np.int64)
+    pointers = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+
+    # Song ids: prefix sums of the gaps within each posting list
+    song_gaps = decode_varints(gather(index.song_stream, index.block_bytes[blocks, 2], index.block_bytes[blocks + 1, 2]))
+    song_ids = segmented_cumsum(song_gaps, lengths)
+
+    # Offsets: prefix sums of the gaps within each run of postings of the same song in a list
+    song_start = song_gaps != 0
+    song_start[pointers[:-1][lengths > 0]] = True
+    run_starts = np.flatnonzero(song_start)
+    offset_gaps = decode_varints(gather(index.offset_stream, index.block_bytes[blocks, 3],
+                                        index.block_bytes[blocks + 1, 3]))
+    offsets = segmented_cumsum(offset_gaps, np.diff(np.append(run_starts, offset_gaps.size)))
+
+    return keys.astype(key_dtype), pointers, song_ids.astype(np.int32), offsets.astype(np.int32)
+
+
+def encode_varints(values):
+    """
+    Encode non-negative integers as LEB128 varints: 7 bits per byte, least significant first, the high bit is set on
+    all but the last byte of a value
+    :param values: The integers
+    :return: The uint8 byte stream and the start of each value in it
+    """
+    values = np.asarray(values).astype(np.uint64)
+    bits = np.zeros(values.size, dtype=np.int64)
+    remaining = values.copy()
+    while np.any(remaining):
+        bits += remaining > 0
+        remaining >>= np.uint64(7)
+    n_bytes = np.maximum(bits, 1)
+
+    starts = np.cumsum(n_bytes) - n_bytes
+    value_of_byte = np.repeat(np.arange(values.size), n_bytes)
+    position = np.arange(value_of_byte.size) - starts[value_of_byte]
+    stream = (values[value_of_byte] >> (np.uint64(7) * position.astype(np.uint64))) & np.uint64(127)
+    more = position < n_bytes[value_of_byte] - 1
+    stream = (stream | (more.astype(np.uint64) << np.uint64(7))).astype(np.uint8)
+    return stream, starts
+
+
+def decode_varints(stream):
+    """
+    Decode a stream of LEB128 varints. Values are assembled from their last (most significant) byte backwards, one
+    byte position per step for all values still having bytes left, so the number of steps is the length of the longest
+    varint rather than the number of values
+    :param stream: The uint8 byte stream, made of complete varints
+    :return: The uint64 values
+    """
+    stream = np.asarray(stream)
+    ends = np.flatnonzero(stream < 128)
+    values = stream[ends].astype(np.uint64)
+    n_bytes = np.diff(ends, prepend=-1)
+    longer = np.flatnonzero(n_bytes > 1)
+    back = 1
+    while longer.size > 0:
+        values[longer] = (values[longer] << np.uint64(7)) | (stream[ends[longer] - back] & 127)
+        back += 1
+        longer = longer[n_bytes[longer] > back]
+    return values
+
+
+def gather(stream, starts, ends):
+    """
+    Concatenate several byte ranges of a stream
+    :param stream: The stream
+    :param starts: Start of each range
+    :param ends: End of each range
+    :return: The concatenated bytes
+    """
+    lengths = ends - starts
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return stream[np.repeat(starts, lengths) + within]
+
+
+def segmented_cumsum(values, lengths):
+    """
+    Prefix sums restarting at every segment
+    :param values: The values of all segments, concatenated
+    :param lengths: The length of each segment
+    :return: The prefix sums
+    """
+    values = np.asarray(values)
+    sums = np.concatenate((np.zeros(1, dtype=values.dtype), np.cumsum(values, dtype=values.dtype)))
+    # Subtract the running total at the start of each segment
+    starts = np.cumsum(lengths) - lengths
+    return sums[1:] - np.repeat(sums[starts], lengths)
+
+
+def save(index, folder):
+    """
+    Save a compressed index segment as plain *.npy files
+    :param index: The CompressedIndex
+    :param folder: The folder to save the segment to. It is created if it does not exist
+    :return: None
+    """
+    os.makedirs(folder, exist_ok=True)
+    for name in compressed_arrays:
+        np.save(folder + os.path.sep + name + ".npy", getattr(index, name))
+
+
+def load(folder, mmap=True):
+    """
+    Load a segment saved with save()
+    :param folder: The folder containing the segment files
+    :param mmap: If True, the arrays are memory-mapped read-only
+    :return: The CompressedIndex
+    """
+    mmap_mode = "r" if mmap else None
+    return CompressedIndex(*[np.load(folder + os.path.sep + name + ".npy", mmap_mode=mmap_mode)
+                             for name in compressed_arrays])
+
+
+def is_compressed(folder):
+    return os.path.exists(folder + os.path.sep + compressed_arrays[0] + ".npy")
+
+
+def measure(index, queries, repetitions=5):
+    """
+    Measure the size and decode speed of the compressed format against the plain one
+    :param index: The Index.FingerprintIndex
+    :param queries: List of query hash key arrays
+    :param repetitions: Number of times the timings are repeated (the best time is reported)
+    :return: Dict with bytes per posting (plain and compressed), full decode throughput (postings per second) and
+    the mean lookup time (ms) per query for both formats
+    """
+    compressed = compress(index)
+    postings = max(int(index.song_ids.size), 1)
+    plain_bytes = sum(np.asarray(column).nbytes for column in (index.keys, index.pointers, index.song_ids, index.offsets))
+
+    def best(function):
+        times = []
+        for _ in range(repetitions):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    decode_seconds = best(lambda: decode_blocks(compressed, np.arange(compressed.first_keys.size)))
+    plain_lookup = best(lambda: [index.lookup(keys) for keys in queries])
+    compressed_lookup = best(lambda: [compressed.lookup(keys) for keys in queries])
+    return {"postings": postings,
+            "plain_bytes_per_posting": plain_bytes / postings,
+            "compressed_bytes_per_posting": compressed.nbytes() / postings,
+            "decode_postings_per_s": postings / decode_seconds if decode_seconds > 0 else None,
+            "plain_lookup_ms": 1000 * plain_lookup / max(len(queries), 1),
+            "compressed_lookup_ms": 1000 * compressed_lookup / max(len(queries), 1)}
@@ -6,133 +6,171 @@ from pathlib import Path
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.utils import shuffle
 from joblib import dump, load
+import ANN
+import Database
+import FeatureStore
 import RP_Fingerprint
-from Constants import database_recordings, generated, clf_name
+from Constants import database_recordings, feature_store, clf_name, labels_name, label_tracks_name, ann_backend, \
+    ann_n_lists, ann_n_probe, rp_query_chunk_frames, rp_early_exit_score
 
 # Path to wavs
 wav_path = "data" + os.path.sep + database_recordings
-# Path to npys
-npy_path = "data" + os.path.sep + generated
-
-labels = []
-
-def query(fp_query):
-    # Load classifier
-    clf = load(clf_name)
-    predictions = []
-    for fp in range(len(fp_query)):
-        current = fp_query[fp]
-        current = current.flatten()
-        # Get k nearest neighbors
-        knn = clf.kneighbors([current])
-        current_predictions = []
-        for neighbor in knn[1][0]:
-            label = labels[neighbor]
-            current_predictions.append(label)
-        # Get data
-        predictions.append(current_predictions)
-
-    # Extract elements
-    candidates = {}
-    for prediction in predictions:
-        # Every prediction here contains a list of candidates (different items) => group them per item
-        for piece in prediction:
-            name = piece[0]
-            time = piece[1]
-            if name not in candidates:
-                candidates[name] = [time]
+
+# Number of tracks fingerprinted before their features are appended to the feature store
+store_chunk_tracks = 64
+
+# Label of each frame vector of the classifier: the track it comes from (position in the track name table), its frame
+# (row in the track's fingerprint) and its start time (in first STFT frames)
+label_dtype = np.dtype([("track", np.int32), ("frame", np.int32), ("time", np.int32)])
+
+# Matcher used by query(), loaded on first use
+matcher = None
+
+
+class Matcher:
+    """
+    Long-lived matcher holding the classifier and its label table, loaded once and reused across queries
+    """
+
+    def __init__(self, mmap=True):
+        """
+        :param mmap: If True, the arrays of the classifier and the label table are memory-mapped read-only
+        """
+        mmap_mode = "r" if mmap else None
+        self.clf = load(clf_name, mmap_mode=mmap_mode)
+        self.labels = np.load(labels_name, mmap_mode=mmap_mode)
+        self.tracks = np.load(label_tracks_name, mmap_mode=mmap_mode)
+
+    def query(self, fp_query, times=None, n_probe=ann_n_probe, early_exit_score=rp_early_exit_score, top_k=3):
+        """
+        Match the frames of a query fingerprint against the database. Every neighbour of a query frame votes for the
+        time offset between the query and its track, the score of a track is the number of votes for its most voted
+        offset. Frames are matched in chunks, the query stops as soon as a track reaches early_exit_score
+        :param fp_query: The query fingerprint (one 6x6 array per frame)
+        :param times: The start times of the query frames, as returned by RP_Fingerprint.compute_fingerprint. None
+        assumes consecutive frames
+        :param n_probe: Number of clusters searched per frame if the approximate backend is used
+        :param early_exit_score: Score at which the query stops early. None matches all frames
+        :param top_k: The number of matches to return
+        :return: The top_k best candidates, mapping their track names to their confidence: the share of the matched
+        query frames which vote for the best offset
+        """
+        frames = np.asarray(fp_query)
+        frames = frames.reshape(frames.shape[0], int(np.prod(frames.shape[1:])))
+        times = np.arange(frames.shape[0]) if times is None else np.asarray(times)
+
+        track_ids = []
+        offset_diffs = []
+        candidates = scores = np.empty(0, dtype=np.int64)
+        matched = 0
+        while matched < frames.shape[0]:
+            chunk = frames[matched:matched + rp_query_chunk_frames]
+            # Get k nearest neighbors of all frames of the chunk in one call
+            if isinstance(self.clf, ANN.IVFIndex):
+                neighbors = self.clf.kneighbors(chunk, n_probe=n_probe, return_distance=False)
             else:
-                candidates[name].append(time)
+                neighbors = self.clf.kneighbors(chunk, return_distance=False)
+
+            found = neighbors >= 0
+            labels = self.labels[neighbors[found]]
+            query_times = np.broadcast_to(times[matched:matched + chunk.shape[0], np.newaxis], neighbors.shape)[found]
+            track_ids.append(labels["track"])
+            offset_diffs.append(labels["time"].astype(np.int64) - query_times)
+            matched += chunk.shape[0]
 
-    # Order candidate dict by name for better overview
-    candidates = {k: v for k, v in sorted(candidates.items(), key=lambda item: item[0])}
-    # candidates = {k: np.sum(np.diff(v)) for k, v in candidates.items()}
-    # candidates = {k: v for k, v in candidates.items() if v > 0}
+            # Maximum histogram bin of each track represents its viability as a candidate
+            if sum(ids.size for ids in track_ids) > 0:
+                candidates, scores = Database.histogram_peaks(np.concatenate(track_ids), np.concatenate(offset_diffs))
+            if early_exit_score is not None and scores.size > 0 and scores.max() >= early_exit_score:
+                break
 
-    # Sort by occurence
-    candidates = {k: v for k, v in sorted(candidates.items(), reverse=True, key=lambda item: len(item[1]))}
-    # Return first three candidates
-    return {k: v for k, v in [x for x in candidates.items()][:3]}
+        # Select best ones, ties are resolved by track id
+        best = np.lexsort((candidates, -scores))[:top_k]
+        return {str(self.tracks[candidates[i]]): float(scores[i] / matched) for i in best}
+
+
+def query(fp_query, times=None, n_probe=ann_n_probe, early_exit_score=rp_early_exit_score):
+    """
+    Match the frames of a query fingerprint against the database, see Matcher.query. The stored classifier is loaded
+    on the first call and reused afterwards
+    """
+    global matcher
+    if matcher is None:
+        matcher = Matcher()
+    return matcher.query(fp_query, times, n_probe, early_exit_score)
 
 
 def train_classifier():
+    """
+    Train the nearest neighbour classifier on the frames of all tracks in the feature store
+    :return: The classifier, its label table (array of label_dtype, one label per frame) and the track names the
+    labels refer to
+    """
     n_neighbors = 7
-    neigh = KNeighborsClassifier(n_neighbors, p=2, weights='distance', leaf_size=400)
-
-    # Create input data: All wav fingerprints
-    X = []
-    # Load npys
-    npys = Path(npy_path).rglob("*.npy")
-    # Add each fingerprint to training data
-    for npy in npys:
-        fingerprint = RP_Fingerprint.read_fingerprint(npy)
-        for column in range(fingerprint.shape[0]):
-            current = fingerprint[column]
-            current = current.flatten()
-            X.append(current)
-            # Store both the npy and the index of the current print as label
-            labels.append((str(npy), column))
+    if ann_backend == "ivf":
+        neigh = ANN.IVFIndex(ann_n_lists, ann_n_probe, n_neighbors)
+    else:
+        neigh = KNeighborsClassifier(n_neighbors, p=2, weights='distance', leaf_size=400)
+
+    # Create input data: All wav fingerprints, read sequentially from the feature store
+    X, times, tracks = FeatureStore.load(feature_store)
+
+    # Store the track, the index of the current print and its start time as label
+    labels = np.empty(X.shape[0], dtype=label_dtype)
+    labels["track"] = np.repeat(np.arange(tracks.size), tracks["count"])
+    labels["frame"] = np.arange(X.shape[0]) - np.repeat(tracks["start"], tracks["count"])
+    labels["time"] = times
 
     # Shuffle data before fitting
     # X, y = shuffle(X, labels)
 
     # Train k nearest neighbors classifier
-    neigh.fit(X, labels)
+    neigh.fit(X, labels["track"])
 
-    return neigh
+    return neigh, labels, tracks["name"]
 
 
-def save_classifier(clf):
+def save_classifier(clf, labels, tracks):
+    """
+    Store the classifier and its label table
+    :param clf: The trained classifier
+    :param labels: Array of label_dtype, one label per training frame
+    :param tracks: The track names referenced by the labels
+    :return: None
+    """
+    global matcher
     dump(clf, clf_name)
-
-
-def exists_in_database(wav):
-    return os.path.exists("data" + os.path.sep + generated + os.path.sep + wav + ".npy")
+    np.save(labels_name, labels)
+    np.save(label_tracks_name, tracks)
+    # Queries load the new classifier
+    matcher = None
 
 
 def initialise():
     """
-    Calculates fingerprints for all recordings in database and stores them in NPYs
+    Calculates fingerprints for all recordings in database which are not in the feature store yet and appends them to
+    the store
     :return:
     """
     # Get all wav paths
-    wavs = Path(wav_path).rglob("*.wav")
-    # Get number of wavs
-    number_of_wavs = len([_ for _ in wavs])  # This call "invalidates" the pathlib object
-
-    # Try to get npy files (only works if they were created previously)
-    number_of_npys = 0
-    try:
-        npys = Path(npy_path).rglob("*.npy")
-        # Get number of npys
-        number_of_npys = len([_ for _ in npys])  # This call "invalidates" the pathlib object
-
-        if number_of_wavs == number_of_npys:
-            print("All fingerprints are already stored in the database...")
-            return
-    except:
-        print("No NPY files found. Generating DB fingerprints anew...")
-
-    if number_of_npys != number_of_wavs:
-        print("Number of NPY files found doesn't match number of wav files. Generating missing fingerprints...")
-        # Reload pathlib objects
-        wavs = Path(wav_path).rglob("*.wav")
-        npys = Path(npy_path).rglob('*.npy')
-
-        # Number of freshly created fingerprints
-        new_fingerprints = 0
-
-        # Generate missing / all fingerprints
-        for wav in wavs:
-            # Convert path to string
-            wav_str = str(wav)
-            # Format
-            wav_str = wav_str[wav_str.rfind(os.path.sep):-4].replace(os.path.sep, "")
-
-            # Only create if there is no fingerprint for that file
-            if not exists_in_database(wav_str):
-                fingerprint, indices = RP_Fingerprint.compute_fingerprint(str(wav))
-                RP_Fingerprint.save_fingerprint(fingerprint, wav_str)
-                new_fingerprints += 1
-
-        print("Done creating fingerprints. New: " + str(new_fingerprints))
+    wavs = sorted(str(wav) for wav in Path(wav_path).rglob("*.wav"))
+
+    # Only create fingerprints for files which are not in the feature store yet
+    stored = set(FeatureStore.load_tracks(feature_store)["name"].tolist())
+    missing = [wav for wav in wavs if wav not in stored]
+    if len(missing) == 0:
+        print("All fingerprints are already stored in the database...")
+        return
+
+    print("Fingerprints of " + str(len(missing)) + " wav files are missing from the feature store. Generating missing "
+          "fingerprints...")
+    # Compute the dataset statistics up front, in parallel, rather than in the first fingerprint
+    if RP_Fingerprint.normalise_stft:
+        RP_Fingerprint.get_mean_std(RP_Fingerprint.stats_workers)
+    # Generate missing fingerprints, appending them to the store in chunks
+    for start in range(0, len(missing), store_chunk_tracks):
+        names = missing[start:start + store_chunk_tracks]
+        fingerprints, times = zip(*[RP_Fingerprint.compute_fingerprint(wav, cache=True) for wav in names])
+        FeatureStore.append(feature_store, names, fingerprints, times)
+
+    print("Done creating fingerprints. New: " + str(len(missing)))
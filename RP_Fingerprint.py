@@ -1,72 +1,64 @@
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
 import numpy as np
 import librosa
 from scipy import signal
+from scipy.ndimage import maximum_filter1d
+from scipy.sparse import csr_matrix
 from scipy.signal import find_peaks
 
+import Audio
+import SpecCache
 import Utility
 from scipy.signal import butter, filtfilt
 from Constants import global_sr, window_length, hop_size, window_length_2, hop_size_2, database_recordings
 
 # Path to wavs
 wav_path = "data" + os.path.sep + database_recordings
-# Folder in which to store generated fingerprints so they don't have to be calculated everytime
-generated = "data" + os.path.sep + "generated"
 
+# Normalise the first STFT by the mean and std of each frequency bin over the whole dataset (see get_mean_std())
+normalise_stft = False
+# File storing the per-bin mean and std of the dataset
+meanstd_file = "meanstd.npy"
+# Number of processes computing the dataset statistics. None uses one process per CPU core
+stats_workers = None
 
-def compute_fingerprint(path):
-    """
-    Compute the fingerpringt for a given signal
-    :param sig: The audio signal
-    :return: The fingerprint
-    """
-    # Load signal and sample rate
-    sig, sr = librosa.load(path, sr=None)
-
-    # Convert signal to mono
-    sig = librosa.core.to_mono(sig)
+# Group the resulting frequency bands into 24 Bark bands
+# NOTE: We omit the 24th bark band as the lower cutoff frequency for the 24rd is 13500Hz and our global
+# SR is 22050Hz
+N_Barks = 23
 
-    # Resample to 22050Hz if generating fingerprint for query
-    if sr != global_sr:
-        sig = librosa.resample(sig, sr, global_sr)
+# Onset detection: E(m) is normalised in blocks of onset_norm_frames, onsets are the maxima of the following
+# onset_plateau_frames frames
+onset_norm_frames = 20
+onset_plateau_frames = 7
 
-    # Try bogus signal distortion
-    # sig = np.concatenate((np.zeros(int(global_sr * 2.234)), sig))
-    # mu, sigma = 0, 0.1
-    # noise = np.random.normal(mu, sigma, sig.shape)
-    # sig += noise
-    # librosa.output.write_wav("data/asdf.wav", sig, global_sr)
-
-    # Get mean and std of dataset
-    mean, std = get_mean_std()
 
+def compute_fingerprint(path, cache=False):
+    """
+    Compute the fingerpringt for a given signal
+    :param path: The path to the audio file
+    :param cache: If True, the first STFT is looked up in and stored to the spectrogram cache, see first_stft()
+    :return: The fingerprints (one 6x6 array per start time) and their start times in first STFT frames
+    """
     # First STFT
     # Compute magnitude STFT with blackman window of 100ms and hop size of 25ms
-    stft = np.abs(
-        librosa.core.stft(sig, n_fft=window_length, hop_length=hop_size, win_length=window_length, window='blackman'))
+    stft = first_stft(path, cache)
 
-    # Normalise by precalculated mean and std
-    # stft = (stft - mean) / std
+    # Normalise each frequency bin by the precalculated mean and std of the dataset
+    if normalise_stft:
+        mean, std = get_mean_std()
+        stft = (stft - mean[:, np.newaxis]) / std[:, np.newaxis]
 
     # Convert power spectrogram to energy spectrogram
     stft = np.power(stft, 2)
 
-    # Group the resulting frequency bands into 24 Bark bands
-    # NOTE: We omit the 24th bark band as the lower cutoff frequency for the 24rd is 13500Hz and our global
-    # SR is 22050Hz
-    N_Barks = 23
     # Calculate Bark bands. This results in Z(b, m) (paper, page 2)
-    spec_bark = np.zeros((N_Barks, stft.shape[1]))
-    for i in range(stft.shape[0]):
-        # Get the current "k" by mapping i to [0, global_sr / 2]
-        k = Utility.mapFromTo(i, 0, stft.shape[0], 0, global_sr / 2)
-        # Convert k to bark frequency
-        k_bark = int(13 * np.arctan(k / 1315.8) + 3.5 * np.arctan(k / 7518.0))
-        # Add energy to k_bark band
-        spec_bark[k_bark] += stft[i]
+    spec_bark = bark_matrix(stft.shape[0]).dot(stft)
 
     # Take six sub bands and convert to sone scale
     spec_bark = librosa.util.normalize(spec_bark[5:11])
@@ -88,127 +80,181 @@ def compute_fingerprint(path):
     onsets = get_onsets(np.copy(spec_bark))
     # onsets = np.arange(0, 320)
 
-    # Get one fingerprint for each onset
-    fps = []
-    indices = []
-    for onset in onsets:
-        if onset + window_length_2 > spec_bark.shape[1]:
-            break
-
-        # Create subset of bark band spectrogram for current position as described in AudioPrint
-        # (Ramona & Peeters, 2013)
-        # This subset consists of 6 frequency bands around 1000Hz
-        short_term_spectra = spec_bark[:, onset: onset + window_length_2]
-
-        # This will contain a list of 4 fingerprints (1 every 0.5s)
-        fingerprint = np.zeros((4, 6, 6))
-        # For each short-term band k calculate the energies of 6 long-term bands
-        for k in range(short_term_spectra.shape[0]):
-            # Current print
-            # Get band and normalise
-            band = np.asfortranarray(librosa.util.normalize(short_term_spectra[k]))
-            p = np.abs(librosa.core.stft(band,
-                                         n_fft=window_length_2,
-                                         hop_length=hop_size_2,
-                                         win_length=window_length_2,
-                                         # center=False,
-                                         window=np.ones(window_length_2)))  # Rectangular window
-
-            # Get frequency band corresponding to 2Hz
-            band_2hz = int((2 / (hop_size_2 / 2)) * (window_length_2 / 2))
-            band_range = p[band_2hz - 3 : band_2hz + 3]
-
-            for frame in range(4):
-                fingerprint[frame, k] = band_range[:, frame]
-
-        # This results in a 4x36-dimensional concatenated vector
-        for frame in range(fingerprint.shape[0]):
-            frameTime = frame * hop_size_2
-            if onset + frameTime in indices:
-                continue
-            fps.append(fingerprint[frame])
-            indices.append(onset + frameTime)
+    # Get one fingerprint for each onset (that is followed by a full window)
+    onsets = onsets[onsets + window_length_2 <= spec_bark.shape[1]]
+    if onsets.size == 0:
+        return np.empty((0, 6, 6)), np.empty(0, dtype=np.int64)
+
+    # Create subset of bark band spectrogram for each onset as described in AudioPrint
+    # (Ramona & Peeters, 2013)
+    # This subset consists of 6 frequency bands around 1000Hz: (onsets x bands x window_length_2)
+    short_term_spectra = np.lib.stride_tricks.sliding_window_view(spec_bark, window_length_2, axis=1)[:, onsets]
+    short_term_spectra = short_term_spectra.transpose(1, 0, 2)
+
+    # Normalise each band (librosa.util.normalize leaves all-zero bands unchanged)
+    maxima = np.abs(short_term_spectra).max(axis=2, keepdims=True)
+    maxima[maxima < np.finfo(maxima.dtype).tiny] = 1
+    bands = short_term_spectra / maxima
+
+    # For each short-term band k calculate the energies of 6 long-term bands with one batched FFT: centered frames of
+    # window_length_2 with a rectangular window, 4 frames (1 every 0.5s) per onset
+    padding = window_length_2 // 2
+    bands = np.pad(bands, ((0, 0), (0, 0), (padding, padding)))
+    frames = np.lib.stride_tricks.sliding_window_view(bands, window_length_2, axis=2)[:, :, :4 * hop_size_2:hop_size_2]
+    p = np.abs(np.fft.rfft(frames, axis=3))
+
+    # Get frequency band corresponding to 2Hz
+    band_2hz = int((2 / (hop_size_2 / 2)) * (window_length_2 / 2))
+    band_range = p[..., band_2hz - 3: band_2hz + 3]
+
+    # This results in a 4x36-dimensional concatenated vector per onset: (onsets x frames x bands x 6)
+    fingerprints = band_range.transpose(0, 2, 1, 3)
+
+    # Keep only the first fingerprint for each start time
+    starts = (onsets[:, np.newaxis] + np.arange(4) * hop_size_2).ravel()
+    _, first = np.unique(starts, return_index=True)
+    first = np.sort(first)
+    fps = fingerprints.reshape(-1, 6, 6)[first]
+    indices = starts[first]
 
     # Notify user
     print("Fingerprint generated for file: " + path)
     return fps, indices
 
 
-def read_fingerprint(path):
-    assert os.path.exists(
-        generated), "Throw error if trying to read from 'generated' folder but the folder does not exist"
-    fingerprint = np.load(path, allow_pickle=True)
-    return fingerprint
-
-
-def save_fingerprint(fingerprint, filename):
-    # Create "generated" directory if not exists
-    if not os.path.exists(generated):
-        os.makedirs(generated)
-    np.save(generated + os.path.sep + filename, fingerprint)
-
-
-def get_mean_std():
-    if os.path.exists("meanstd.npy"):
-        meanstd = np.load("meanstd.npy")
-        mean = meanstd[0]
-        std = meanstd[1]
-    else:
-        # Get mean and std of whole dataset
-        mean = 0
-        std = 0
-        counter = 0
-        for wav in Path(wav_path).rglob("*.wav"):
-            sys.stdout.write("\rCalculating STFT %i of 300" % counter)
-            sys.stdout.flush()
-            counter += 1
-            # Load signal and sample rate
-            sig, sr = librosa.load(wav, sr=None)
-
-            # Convert signal to mono
-            sig = librosa.core.to_mono(sig)
-
-            # Resample to 22050Hz if generating fingerprint for query
-            if sr != global_sr:
-                sig = librosa.resample(sig, sr, global_sr)
-            stft = np.abs(
-                librosa.core.stft(sig, n_fft=window_length, hop_length=hop_size, win_length=window_length,
-                                  window='blackman'))
-            mean += np.mean(stft)
-            std += np.std(stft)
-
-        mean /= 300
-        std /= 300
-        np.save("meanstd", np.array([mean, std]))
+@lru_cache(maxsize=None)
+def bark_matrix(n_bins):
+    """
+    Sparse matrix summing the energy of STFT bins into Bark bands
+    :param n_bins: Number of STFT frequency bins
+    :return: N_Barks x n_bins matrix
+    """
+    # Get the current "k" by mapping each bin to [0, global_sr / 2]
+    k = Utility.mapFromTo(np.arange(n_bins), 0, n_bins, 0, global_sr / 2)
+    # Convert k to bark frequency
+    k_bark = (13 * np.arctan(k / 1315.8) + 3.5 * np.arctan(k / 7518.0)).astype(int)
+    return csr_matrix((np.ones(n_bins), (k_bark, np.arange(n_bins))), shape=(N_Barks, n_bins))
+
+
+def first_stft(path, cache=False):
+    """
+    Compute the magnitude STFT with blackman window of 100ms and hop size of 25ms
+    :param path: The path to the audio file
+    :param cache: If True, the spectrogram is looked up in and stored to the spectrogram cache (by file content and
+    STFT parameters). Only worth it for the database recordings, which the statistics pass reads as well
+    :return: The magnitude spectrogram (frequency bins x frames)
+    """
+    stft = None
+    if cache:
+        spec_key = SpecCache.key(path, ("magnitude", window_length, hop_size, global_sr, "blackman", "polyphase"))
+        stft = SpecCache.load(spec_key)
+    if stft is None:
+        # Load signal, convert it to mono and resample to global_sr if generating fingerprint for query
+        sig = Audio.load(path, global_sr)
+
+        # Try bogus signal distortion
+        # sig = np.concatenate((np.zeros(int(global_sr * 2.234)), sig))
+        # mu, sigma = 0, 0.1
+        # noise = np.random.normal(mu, sigma, sig.shape)
+        # sig += noise
+        # librosa.output.write_wav("data/asdf.wav", sig, global_sr)
+
+        stft = np.abs(
+            librosa.core.stft(sig, n_fft=window_length, hop_length=hop_size, win_length=window_length,
+                              window='blackman'))
+        if cache:
+            SpecCache.store(spec_key, stft)
+    return stft
+
+
+def get_mean_std(workers=stats_workers):
+    """
+    Get the mean and std of each frequency bin of the first STFT over all frames of the dataset. They are computed in
+    one streaming pass over the database recordings, merging the moments of each file, and stored in meanstd_file
+    :param workers: Number of processes computing the moments of the files in parallel. None uses one process per CPU
+    core
+    :return: The mean and the std of each frequency bin
+    """
+    if os.path.exists(meanstd_file):
+        meanstd = np.load(meanstd_file)
+        # Files holding one dataset-wide mean and std (older format) are recomputed
+        if meanstd.ndim == 2:
+            return meanstd[0], meanstd[1]
+
+    # Get mean and std of whole dataset
+    wavs = sorted(Path(wav_path).rglob("*.wav"))
+    moments = (0, np.zeros(window_length // 2 + 1), np.zeros(window_length // 2 + 1))
+    for counter, file_moments in enumerate(moments_all(wavs, workers)):
+        sys.stdout.write("\rCalculating STFT statistics %i of %i" % (counter + 1, len(wavs)))
+        sys.stdout.flush()
+        moments = merge_moments(moments, file_moments)
+    print()
+
+    count, mean, m2 = moments
+    std = np.sqrt(m2 / max(count, 1))
+    # Bins without any variation are left unscaled
+    std[std == 0] = 1
+    np.save(meanstd_file, np.stack((mean, std)))
 
     return mean, std
 
 
+def moments_all(wavs, workers=1):
+    """
+    Compute the moments of many files, optionally in parallel
+    :param wavs: List of paths to *.wav files
+    :param workers: Number of worker processes. 1 computes the moments in the current process, None uses one process
+    per CPU core
+    :return: Generator yielding the moments of each file in the order of wavs, see moments()
+    """
+    if workers == 1:
+        yield from map(moments, wavs)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(moments, wavs)
+
+
+def moments(path):
+    """
+    Compute the moments of each frequency bin of the first STFT of a file
+    :param path: The path to the audio file
+    :return: The number of frames, the mean and the sum of squared deviations from the mean of each frequency bin
+    """
+    stft = first_stft(path, cache=True).astype(np.float64)
+    mean = stft.mean(axis=1)
+    return stft.shape[1], mean, np.square(stft - mean[:, np.newaxis]).sum(axis=1)
+
+
+def merge_moments(a, b):
+    """
+    Merge the moments of two sets of frames (Chan et al.'s parallel variant of Welford's algorithm)
+    :param a: Moments (count, mean, sum of squared deviations) of the first set
+    :param b: Moments of the second set
+    :return: The moments of the union of both sets
+    """
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    if count == 0:
+        return a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (count_b / count)
+    m2 = m2_a + m2_b + np.square(delta) * (count_a * count_b / count)
+    return count, mean, m2
+
+
 def get_onsets(bark):
-    # Calculate E(m) for each m (frame time)
-    Em = []
-    bands = bark.shape[0]  # Will be 6
-    frames = bark.shape[1]
-    for m in range(frames):
-        current = (1 / bands) * np.sum(bark[:, m])
-        Em.append(current)
-
-    Em = np.array(Em)
-    # Normalise with a sliding window of 20 frames
-    for i in range(0, Em.shape[0], 20):
-        lookahead = Em.shape[0] - i if i + 20 > Em.shape[0] else 20
-        current = Em[i: i + lookahead]
-        Em[i: i + 20] = (current - np.median(current)) / np.std(current)
+    """
+    Find onsets: frames where the normalised band energy is the maximum of the next onset_plateau_frames frames
+    :param bark: The Bark band spectrogram (bands x frames)
+    :return: The onset frames
+    """
+    # Calculate E(m) for each m (frame time) and normalise with a sliding window of 20 frames
+    Em = normalise_energy(band_energy(bark))
 
     # Create "Plateau" signal of 7 frames
-    Pm = np.zeros(Em.shape[0])
-    back = 7
-    ahead = 7
-    for i in range(Em.shape[0]):
-        back = 0 if i - back < 0 else back
-        ahead = ahead if i + ahead <= Em.shape[0] else Em.shape[0] - i
-
-        Pm[i] = np.max(Em[i - back : i + ahead])
+    Pm = plateau(Em)
 
     # Create local maxima mask
     # Those are all frame positions for which Em and Pm are equal
@@ -217,3 +263,87 @@ def get_onsets(bark):
     onsets = np.nonzero(local_maxima)[0]
 
     return onsets
+
+
+def band_energy(bark):
+    """
+    Calculate E(m), the mean energy over all bands, for each m (frame time)
+    :param bark: The Bark band spectrogram (bands x frames)
+    :return: E(m)
+    """
+    bands = bark.shape[0]  # Will be 6
+    return (1 / bands) * bark.sum(axis=0)
+
+
+def normalise_energy(Em):
+    """
+    Normalise E(m) block-wise: each block of onset_norm_frames frames (the last one may be shorter) has its median
+    subtracted and is divided by its standard deviation
+    :param Em: E(m)
+    :return: The normalised E(m)
+    """
+    Em = np.array(Em, dtype=np.float64)
+    complete = Em.size // onset_norm_frames * onset_norm_frames
+    blocks = Em[:complete].reshape(-1, onset_norm_frames)
+    blocks[:] = (blocks - np.median(blocks, axis=1, keepdims=True)) / np.std(blocks, axis=1, keepdims=True)
+    if complete < Em.size:
+        tail = Em[complete:]
+        Em[complete:] = (tail - np.median(tail)) / np.std(tail)
+    return Em
+
+
+def plateau(Em):
+    """
+    Create the "Plateau" signal: the maximum of E(m) over the frames m ... m + onset_plateau_frames - 1 (clipped at the
+    end). Windows containing NaN (blocks without any variation) have no maximum
+    :param Em: The normalised E(m)
+    :return: P(m)
+    """
+    # NaN becomes +inf, so that no frame of a window containing NaN equals the window's maximum
+    Em = np.where(np.isnan(Em), np.inf, Em)
+    return maximum_filter1d(Em, onset_plateau_frames, origin=-(onset_plateau_frames // 2), mode='nearest')
+
+
+class OnsetDetector:
+    """
+    Streaming onset detection for Bark band spectrograms arriving in blocks of frames. The concatenated onsets of
+    process() and flush() are equal to get_onsets() of the whole spectrogram
+    """
+
+    def __init__(self):
+        # E(m) of the frames of the current, incomplete normalisation block
+        self.energy = np.empty(0)
+        # Normalised E(m) of the frames from self.start on, which have not been decided yet
+        self.normalised = np.empty(0)
+        self.start = 0
+
+    def process(self, bark):
+        """
+        Add the next frames
+        :param bark: The next frames of the Bark band spectrogram (bands x frames)
+        :return: The onsets (absolute frame indices) which can be decided with the frames seen so far
+        """
+        self.energy = np.concatenate((self.energy, band_energy(bark)))
+        complete = self.energy.size // onset_norm_frames * onset_norm_frames
+        self.normalised = np.concatenate((self.normalised, normalise_energy(self.energy[:complete])))
+        self.energy = self.energy[complete:]
+        return self.decide(self.normalised.size - (onset_plateau_frames - 1))
+
+    def flush(self):
+        """
+        Finish the spectrogram
+        :return: The remaining onsets
+        """
+        self.normalised = np.concatenate((self.normalised, normalise_energy(self.energy)))
+        self.energy = np.empty(0)
+        return self.decide(self.normalised.size)
+
+    def decide(self, end):
+        if end <= 0:
+            return np.empty(0, dtype=np.int64)
+        # The plateau of the first end frames only depends on frames which are already normalised
+        local_maxima = np.equal(self.normalised[:end], plateau(self.normalised)[:end])
+        onsets = np.nonzero(local_maxima)[0] + self.start
+        self.normalised = self.normalised[end:]
+        self.start += end
+        return onsets
@@ -9,7 +9,7 @@ from Constants import clf_name, query_recordings
 
 def analyse(path):
     fp_query, indices = RP_Fingerprint.compute_fingerprint(path)
-    candidates = RP_Database.query(fp_query)
+    candidates = RP_Database.query(fp_query, indices)
 
     res = []
     # Get results
@@ -43,8 +43,8 @@ RP_Database.initialise()
 
 # Train classifier if it doesn't exist yet
 # if not os.path.exists(clf_name):
-clf = RP_Database.train_classifier()
-RP_Database.save_classifier(clf)
+clf, labels, tracks = RP_Database.train_classifier()
+RP_Database.save_classifier(clf, labels, tracks)
 
 # analyse("data/query_recordings/pop.00050-snippet-10-0.wav")
 # analyse("data/database_recordings/pop.00050.wav")
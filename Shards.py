@@ -0,0 +1,261 @@
+import multiprocessing
+import os
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+import Database
+import Index
+import Utility
+
+# Folder (inside the fingerprint database folder) holding one sub-folder per shard and the file with the key ranges
+shards_folder = "shards"
+bounds_file = "bounds.npy"
+
+# Default number of shards
+default_shards = 4
+
+# Default address of a shard worker. Port 0 picks a free port
+worker_address = ("127.0.0.1", 0)
+
+
+def split(folder, n_shards=default_shards):
+    """
+    Partition the index of a fingerprint database into shards by hash key range. The ranges are chosen so that every
+    shard holds about the same number of postings. Each index segment is split into contiguous key slices, so the
+    index is never loaded into memory as a whole. The shards have to be split again after the database was updated
+    :param folder: The fingerprint database folder
+    :param n_shards: Number of shards
+    :return: The key range bounds: shard i holds the keys in [bounds[i], bounds[i + 1])
+    """
+    database = Index.load(folder)
+    bounds = key_bounds(database, n_shards)
+
+    for shard in range(n_shards):
+        shard_folder = shard_path(folder, shard)
+        for number, segment in zip(Index.load_manifest(folder), database.segments):
+            # Keys are sorted, so the keys of a shard are a contiguous slice of each segment
+            first, last = np.searchsorted(segment.keys, bounds[shard:shard + 2])
+            start, end = segment.pointers[first], segment.pointers[last]
+            part = Index.FingerprintIndex(np.asarray(segment.keys[first:last]),
+                                          np.asarray(segment.pointers[first:last + 1]) - start,
+                                          np.asarray(segment.song_ids[start:end]),
+                                          np.asarray(segment.offsets[start:end]))
+            Index.save_segment(part, Index.segment_path(shard_folder, number))
+        Utility.save_atomic(shard_folder + os.path.sep + Index.manifest_file, Index.load_manifest(folder))
+
+    Utility.save_atomic(folder + os.path.sep + shards_folder + os.path.sep + bounds_file, bounds)
+    return bounds
+
+
+def key_bounds(database, n_shards):
+    """
+    Choose key range bounds which spread the postings evenly over the shards
+    :param database: The SegmentedIndex
+    :param n_shards: Number of shards
+    :return: Array of n_shards + 1 increasing bounds, the first one is 0 and the last one is above every key
+    """
+    keys = np.concatenate([np.empty(0, dtype=np.uint64)] + [segment.keys.astype(np.uint64)
+                                                             for segment in database.segments])
+    lengths = np.concatenate([np.empty(0, dtype=np.int64)] + [np.diff(segment.pointers)
+                                                               for segment in database.segments])
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    postings = np.cumsum(lengths[order])
+
+    bounds = np.zeros(n_shards + 1, dtype=np.uint64)
+    bounds[-1] = int(keys[-1]) + 1 if keys.size > 0 else 1
+    if keys.size > 0:
+        # First key of each shard: the key at which the running number of postings passes i / n_shards of the total
+        targets = postings[-1] * np.arange(1, n_shards) / n_shards
+        bounds[1:-1] = keys[np.minimum(np.searchsorted(postings, targets, side="right"), keys.size - 1)]
+    return np.maximum.accumulate(bounds)
+
+
+def shard_path(folder, shard):
+    return folder + os.path.sep + shards_folder + os.path.sep + "%03d" % shard
+
+
+def load_bounds(folder):
+    return np.load(folder + os.path.sep + shards_folder + os.path.sep + bounds_file)
+
+
+def load_shard(folder, shard, mmap=True):
+    """
+    Load the index of one shard
+    :param folder: The fingerprint database folder
+    :param shard: The shard number
+    :param mmap: If True, the shard is memory-mapped read-only
+    :return: The SegmentedIndex of the shard
+    """
+    shard_folder = shard_path(folder, shard)
+    segments = [Index.load_segment(Index.segment_path(shard_folder, number), mmap)
+                for number in Index.load_manifest(shard_folder)]
+    alive = np.asarray(Index.load_names(folder, mmap)) != ""
+    return Index.SegmentedIndex(segments, alive, Index.load_stop_list(folder))
+
+
+def serve(folder, shard, address=worker_address, authkey=None, ready=None):
+    """
+    Serve one shard: answer histogram requests of a coordinator (ShardedIndex) until it sends "close". Requests and
+    replies are tuples sent over a multiprocessing connection:
+    ("histogram", keys, offsets, max_postings) -> ("ok", (song_ids, offset_diffs, counts)) with the offset difference
+    histogram bins of the query hashes in this shard, see Database.histogram
+    ("stats",) -> ("ok", posting list statistics of the shard)
+    ("close",) -> the worker exits
+    Failed requests are answered with ("error", message)
+    :param folder: The fingerprint database folder
+    :param shard: The shard number
+    :param address: The (host, port) to listen on
+    :param authkey: Key the coordinator has to authenticate with. Required: requests are unpickled, so without it any
+    process reaching the port could run code in the worker
+    :param ready: Optional connection the actual listening address is sent to once the shard is loaded
+    :return: None
+    """
+    if not authkey:
+        raise ValueError("Shard workers need an authkey")
+    index = load_shard(folder, shard)
+    with Listener(address, authkey=authkey) as listener:
+        if ready is not None:
+            ready.send(listener.address)
+            ready.close()
+
+        while True:
+            with listener.accept() as connection:
+                while True:
+                    try:
+                        request = connection.recv()
+                    except EOFError:
+                        # Coordinator went away, wait for the next one
+                        break
+                    if request[0] == "close":
+                        return
+                    try:
+                        connection.send(("ok", handle(index, request)))
+                    except Exception as error:
+                        connection.send(("error", repr(error)))
+
+
+def handle(index, request):
+    """
+    Answer a request to a shard worker, see serve()
+    :param index: The index of the shard
+    :param request: The request tuple
+    :return: The reply payload
+    """
+    if request[0] == "histogram":
+        _, keys, offsets, max_postings = request
+        query_idx, song_ids, db_offsets = index.lookup(keys, max_postings)
+        offset_diffs = db_offsets.astype(np.int64) - np.asarray(offsets, dtype=np.int64)[query_idx]
+        return Database.histogram(song_ids, offset_diffs)
+    if request[0] == "stats":
+        return Index.posting_stats(index)
+    raise ValueError("Unknown request " + str(request[0]))
+
+
+class ShardedIndex:
+    """
+    Coordinator of a sharded index. Scatters the hashes of a query to the shards holding their key ranges and merges
+    the offset difference histograms of the shards, which gives the same results as Database.search on the whole index
+    """
+
+    def __init__(self, folder, addresses=None, authkey=None):
+        """
+        :param folder: The fingerprint database folder, split with split()
+        :param addresses: The (host, port) of a running worker (see serve()) for each shard. None starts one local
+        worker process per shard
+        :param authkey: Key to authenticate with the workers, required with addresses. Local workers get a random key
+        """
+        if addresses is not None and not authkey:
+            raise ValueError("Connecting to shard workers needs their authkey")
+        self.bounds = load_bounds(folder)
+        n_shards = self.bounds.size - 1
+        self.processes = []
+        if addresses is None:
+            authkey = os.urandom(16)
+            addresses = [self._start_worker(folder, shard, authkey) for shard in range(n_shards)]
+        self.connections = [Client(tuple(address), authkey=authkey) for address in addresses]
+
+    def _start_worker(self, folder, shard, authkey):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=serve, args=(folder, shard, worker_address, authkey, sender),
+                                          daemon=True)
+        process.start()
+        sender.close()
+        self.processes.append(process)
+        return receiver.recv()
+
+    def search(self, ids_names, fp_query, top_k=3, max_postings=Database.query_max_postings):
+        """
+        Search the sharded index for a query, see Database.search
+        :param ids_names: The map from song ids to names
+        :param fp_query: The query fingerprint (arrays of hash keys and offsets)
+        :param top_k: The number of matches to return
+        :param max_postings: Query hashes with more postings than this are ignored. Shards hold all postings of a key,
+        so this gives the same cutoff as on the whole index
+        :return: The names of the top_k best matches
+        """
+        keys_q, offsets_q = fp_query
+        keys_q = np.asarray(keys_q)
+        offsets_q = np.asarray(offsets_q)
+
+        # Scatter: every shard gets the query hashes in its key range, all shards work at the same time
+        shard_of = np.searchsorted(self.bounds, keys_q.astype(np.uint64), side="right") - 1
+        for shard, connection in enumerate(self.connections):
+            in_shard = shard_of == shard
+            connection.send(("histogram", keys_q[in_shard], offsets_q[in_shard], max_postings))
+
+        # Gather: a (song, offset difference) bin can get matches from several shards, so the counts are summed
+        parts = [self._reply(connection) for connection in self.connections]
+        song_ids, offset_diffs, counts = [np.concatenate([part[i] for part in parts]) for i in range(3)]
+        songs, _, counts = Database.histogram(song_ids, offset_diffs, weights=counts)
+        candidates, scores = Database.histogram_maxima(songs, counts)
+
+        # Select best ones, ties are resolved by song id
+        best = candidates[np.lexsort((candidates, -scores))[:top_k]]
+        return [ids_names[song_id] for song_id in best]
+
+    def stats(self):
+        """
+        :return: The posting list statistics of each shard
+        """
+        for connection in self.connections:
+            connection.send(("stats",))
+        return [self._reply(connection) for connection in self.connections]
+
+    @staticmethod
+    def _reply(connection):
+        status, payload = connection.recv()
+        if status == "error":
+            raise RuntimeError("Shard worker failed: " + payload)
+        return payload
+
+    def close(self):
+        """
+        Stop the workers started by this coordinator and close all connections
+        :return: None
+        """
+        for connection in self.connections:
+            if self.processes:
+                connection.send(("close",))
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+# Example use from Python file
+# Shards.split("fingerprints", 4)
+# with Shards.ShardedIndex("fingerprints") as sharded:
+#     sharded.search(Index.load_names("fingerprints"), Fingerprint.compute_fingerprint("query.wav"))
+#
+# Workers on other machines, sharing a secret key (e.g. from os.urandom(16)) with the coordinator:
+# python -c 'import Shards; Shards.serve("fingerprints", 0, ("10.0.0.2", 6000), secret)'
+# and Shards.ShardedIndex("fingerprints", [("10.0.0.2", 6000), ...], secret)
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+import Instrumentation
+import Utility
+from Constants import spec_cache, spec_cache_max_bytes
+
+# Temporary files older than this many seconds were left by killed processes and are deleted when evicting
+stale_tmp_seconds = 300
+
+# Estimated size of the cache folder, None until the folder was scanned by this process
+cache_bytes = None
+
+
+def key(path, params, digest=None):
+    """
+    Compute the cache key of a spectrogram
+    :param path: Path to the audio file
+    :param params: Tuple of all parameters the spectrogram depends on (e.g. N_FFT, HOP_SIZE, global_sr)
+    :param digest: The SHA-1 digest of the file content if already known, the file is then not read
+    :return: Hex key derived from the file content and the parameters. Files with the same content share a key,
+    whatever their name or folder
+    """
+    if digest is None:
+        digest = Utility.file_digest(path)
+    value = digest + "|" + "|".join(str(param) for param in params)
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+def load(spec_key):
+    """
+    Load a spectrogram from the cache. Time spent is recorded in the "spec_cache" stage, hits and misses in the
+    spec_cache_hits / spec_cache_misses counters
+    :param spec_key: The key computed by key()
+    :return: The spectrogram or None if it is not cached
+    """
+    with Instrumentation.timer("spec_cache"):
+        spec_path = cache_path(spec_key)
+        try:
+            spec = np.load(spec_path)
+        except (FileNotFoundError, OSError, ValueError):
+            Instrumentation.count("spec_cache_misses")
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(spec_path)
+        except FileNotFoundError:
+            # Evicted by another process after loading, the loaded spectrogram is still valid
+            pass
+        Instrumentation.count("spec_cache_hits")
+        return spec
+
+
+def store(spec_key, spec):
+    """
+    Store a spectrogram in the cache as plain float32 .npy file and evict least recently used spectrograms if the cache
+    grows beyond spec_cache_max_bytes. Compressing the file costs several times more than computing the spectrogram
+    :param spec_key: The key computed by key()
+    :param spec: The spectrogram
+    :return: None
+    """
+    global cache_bytes
+    with Instrumentation.timer("spec_cache"):
+        Path(spec_cache).mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first so that other processes never load a partially written spectrogram
+        spec_path = cache_path(spec_key)
+        tmp_path = spec_path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.asarray(spec, dtype=np.float32))
+        os.replace(tmp_path, spec_path)
+
+        if cache_bytes is None:
+            cache_bytes = folder_size()
+        else:
+            cache_bytes += os.path.getsize(spec_path)
+
+        if cache_bytes > spec_cache_max_bytes:
+            evict()
+
+
+def evict():
+    """
+    Delete temporary files left by killed processes, then least recently used spectrograms until the cache is within
+    spec_cache_max_bytes. Temporary files still being written count towards the cache size
+    :return: None
+    """
+    global cache_bytes
+    entries = []
+    tmp_bytes = 0
+    stale_before = time.time_ns() - stale_tmp_seconds * 10 ** 9
+    for entry in os.scandir(spec_cache):
+        try:
+            stat = entry.stat()
+            if entry.name.endswith(".npy"):
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            elif entry.name.endswith(".tmp"):
+                if stat.st_mtime_ns < stale_before:
+                    os.remove(entry.path)
+                    Instrumentation.count("spec_cache_stale_tmp")
+                else:
+                    tmp_bytes += stat.st_size
+        except FileNotFoundError:
+            # Renamed or deleted by another process
+            pass
+    entries.sort()
+
+    cache_bytes = tmp_bytes + sum(size for _, size, _ in entries)
+    for _, size, spec_path in entries:
+        if cache_bytes <= spec_cache_max_bytes:
+            break
+        try:
+            os.remove(spec_path)
+        except FileNotFoundError:
+            # Already evicted by another process
+            pass
+        cache_bytes -= size
+        Instrumentation.count("spec_cache_evictions")
+
+
+def folder_size():
+    if not os.path.exists(spec_cache):
+        return 0
+    size = 0
+    for entry in os.scandir(spec_cache):
+        if entry.name.endswith((".npy", ".tmp")):
+            try:
+                size += entry.stat().st_size
+            except FileNotFoundError:
+                # Renamed or deleted by another process
+                pass
+    return size
+
+
+def cache_path(spec_key):
+    return spec_cache + os.path.sep + spec_key + ".npy"
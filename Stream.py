@@ -0,0 +1,243 @@
+import numpy as np
+from scipy.signal import get_window
+
+import Audio
+import Database
+import Fingerprint
+from Constants import global_sr, N_FFT, HOP_SIZE, stream_block_seconds, stream_hop_seconds, \
+    stream_window_seconds, stream_min_score
+
+# Range in which dB values are kept below the loudest value seen so far (as in librosa.power_to_db)
+top_db = 80.0
+
+
+class StreamIdentifier:
+    """
+    Identifies songs in an audio stream. PCM chunks are fed as they arrive, the spectrogram is extended frame by frame,
+    peaks are detected as soon as their neighbourhood is complete and hashed in overlapping blocks of
+    stream_block_seconds every stream_hop_seconds. New hashes are looked up right away and a match is reported once its
+    offset-histogram score reaches min_score
+    """
+
+    def __init__(self, database, ids_names, sr=global_sr, min_score=stream_min_score,
+                 block_seconds=stream_block_seconds, hop_seconds=stream_hop_seconds,
+                 window_seconds=stream_window_seconds):
+        """
+        :param database: The loaded database object (Index.SegmentedIndex)
+        :param ids_names: The loaded ID to name map
+        :param sr: Sampling rate of the fed PCM chunks
+        :param min_score: Minimum offset-histogram score for reporting a match
+        :param block_seconds: Length of the blocks of peaks which are hashed together
+        :param hop_seconds: Time between two blocks, which is also the delay with which new peaks are hashed
+        :param window_seconds: Only matches from this many most recent seconds of the stream are used for scoring
+        """
+        self.database = database
+        self.ids_names = ids_names
+        self.sr = sr
+        self.min_score = min_score
+        self.block_frames = max(1, int(block_seconds * global_sr / HOP_SIZE))
+        self.hop_frames = max(1, int(hop_seconds * global_sr / HOP_SIZE))
+        self.window_frames = int(window_seconds * global_sr / HOP_SIZE)
+        self.window = get_window('hann', N_FFT)
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the stream position and all matches
+        :return: None
+        """
+        self.resampler = Audio.Resampler(self.sr, global_sr)
+        # Samples not yet consumed by the STFT, starting with the zero padding of a centered STFT
+        self.samples = np.zeros(N_FFT // 2, dtype=np.float32)
+        # dB spectrogram columns from frame self.spec_start onwards
+        self.spec = np.empty((N_FFT // 2 + 1, 0), dtype=np.float32)
+        self.spec_start = 0
+        self.max_db = -np.inf
+        # First frame whose peaks are not final yet
+        self.final_frames = 0
+        # Final peaks which are part of the next block
+        self.peak_frames = np.empty(0, dtype=np.int64)
+        self.peak_freqs = np.empty(0, dtype=np.int64)
+        self.peak_values = np.empty(0, dtype=np.float32)
+        # End of the last hashed block and (offset << key_bits | key) of the hashes emitted by recent blocks
+        self.block_end = 0
+        self.emitted = np.empty(0, dtype=np.int64)
+        self.clear_matches()
+
+    def clear_matches(self):
+        self.match_song_ids = np.empty(0, dtype=np.int32)
+        self.match_diffs = np.empty(0, dtype=np.int64)
+        self.match_frames = np.empty(0, dtype=np.int64)
+
+    def feed(self, chunk):
+        """
+        Process a chunk of PCM samples
+        :param chunk: Array of samples (frames x channels or mono)
+        :return: List of (song name, score, stream time in seconds) for matches reported while processing the chunk
+        """
+        chunk = np.asarray(chunk, dtype=np.float32)
+        if chunk.ndim > 1:
+            chunk = chunk.mean(axis=1)
+        chunk = self.resampler.process(chunk)
+
+        self.samples = np.concatenate((self.samples, chunk))
+        self.extend_spectrogram()
+
+        # Peaks are final once the whole neighbourhood of their frame is known
+        total_frames = self.spec_start + self.spec.shape[1]
+        self.detect_peaks(total_frames - Fingerprint.peak_neighbourhood_size)
+
+        return self.hash_blocks(flush=False)
+
+    def flush(self):
+        """
+        Finish the stream: pad the end like a centered STFT does and process all remaining peaks
+        :return: See feed()
+        """
+        self.samples = np.concatenate((self.samples, self.resampler.flush(), np.zeros(N_FFT // 2, dtype=np.float32)))
+        self.extend_spectrogram()
+        self.detect_peaks(self.spec_start + self.spec.shape[1])
+        return self.hash_blocks(flush=True)
+
+    def extend_spectrogram(self):
+        """
+        Compute the STFT frames for which all samples are available
+        """
+        if self.samples.size < N_FFT:
+            return
+        frames = np.lib.stride_tricks.sliding_window_view(self.samples, N_FFT)[::HOP_SIZE]
+        self.samples = self.samples[frames.shape[0] * HOP_SIZE:]
+
+        power = np.abs(np.fft.rfft(frames * self.window, axis=1).T) ** 2
+        spec = 10.0 * np.log10(np.maximum(1e-10, power))
+        self.max_db = max(self.max_db, spec.max())
+        spec = np.maximum(spec, self.max_db - top_db).astype(np.float32)
+        self.spec = np.concatenate((self.spec, spec), axis=1)
+
+    def detect_peaks(self, final_end):
+        """
+        Detect the peaks of all frames in [self.final_frames, final_end)
+        """
+        if final_end <= self.final_frames:
+            return
+        margin = Fingerprint.peak_neighbourhood_size
+
+        # Run the detector with a full neighbourhood of context on both sides
+        start = max(self.spec_start, self.final_frames - margin)
+        window = self.spec[:, start - self.spec_start:]
+        frames, freqs = Fingerprint.detect_peaks(window)
+        values = window[freqs, frames]
+        frames = frames + start
+
+        keep = (frames >= self.final_frames) & (frames < final_end)
+        self.peak_frames = np.concatenate((self.peak_frames, frames[keep]))
+        self.peak_freqs = np.concatenate((self.peak_freqs, freqs[keep]))
+        self.peak_values = np.concatenate((self.peak_values, values[keep]))
+        self.final_frames = final_end
+
+        # Drop spectrogram frames which are no longer needed as context
+        drop = max(0, self.final_frames - margin - self.spec_start)
+        self.spec = self.spec[:, drop:]
+        self.spec_start += drop
+
+    def hash_blocks(self, flush):
+        """
+        Every hop_frames, hash the final peaks of the last block_frames, look the new hashes up and score the matches
+        """
+        matches = []
+        while self.final_frames >= self.block_end + self.hop_frames or (flush and self.block_end < self.final_frames):
+            self.block_end += self.hop_frames
+            in_block = self.peak_frames < self.block_end
+
+            # Order the peaks of the block like the offline detector does: by decreasing intensity
+            order = np.lexsort((self.peak_frames[in_block], self.peak_freqs[in_block], -self.peak_values[in_block]))
+            keys, offsets = Fingerprint.create_hash(self.peak_frames[in_block][order], self.peak_freqs[in_block][order])
+
+            # Blocks overlap, only hashes which were not emitted by a previous block are new
+            emitted = offsets.astype(np.int64) << Fingerprint.key_bits | keys.astype(np.int64)
+            new = ~np.isin(emitted, self.emitted)
+            recent = self.emitted >> Fingerprint.key_bits >= self.block_end - self.block_frames
+            self.emitted = np.union1d(self.emitted[recent], emitted)
+
+            # Forget peaks which are too old to be part of the next block
+            keep = self.peak_frames >= self.block_end + self.hop_frames - self.block_frames
+            self.peak_frames = self.peak_frames[keep]
+            self.peak_freqs = self.peak_freqs[keep]
+            self.peak_values = self.peak_values[keep]
+
+            match = self.score((keys[new], offsets[new]), self.block_end)
+            if match is not None:
+                matches.append(match)
+
+        return matches
+
+    def score(self, fp_block, block_end):
+        """
+        Add the matches of a block of hashes and check whether a song reaches min_score
+        :return: (song name, score, stream time in seconds) or None
+        """
+        keys, offsets = fp_block
+        query_idx, song_ids, db_offsets = self.database.lookup(keys)
+        self.match_song_ids = np.concatenate((self.match_song_ids, song_ids))
+        self.match_diffs = np.concatenate((self.match_diffs, db_offsets.astype(np.int64) - offsets[query_idx]))
+        self.match_frames = np.concatenate((self.match_frames, offsets[query_idx].astype(np.int64)))
+
+        # Forget matches which left the scoring window
+        recent = self.match_frames >= block_end - self.window_frames
+        self.match_song_ids = self.match_song_ids[recent]
+        self.match_diffs = self.match_diffs[recent]
+        self.match_frames = self.match_frames[recent]
+        if self.match_song_ids.size == 0:
+            return None
+
+        candidates, scores = Database.histogram_peaks(self.match_song_ids, self.match_diffs)
+        best = np.lexsort((candidates, -scores))[0]
+        if scores[best] < self.min_score:
+            return None
+
+        # Start collecting evidence for the next song
+        self.clear_matches()
+        return self.ids_names[candidates[best]], int(scores[best]), block_end * HOP_SIZE / global_sr
+
+
+def identify_stream(database, ids_names, chunks, sr=global_sr, **kwargs):
+    """
+    Identify songs in a stream of PCM chunks
+    :param database: The loaded database object
+    :param ids_names: The loaded ID to name map
+    :param chunks: Iterable of PCM chunks, e.g. read_pcm() or a generator of arrays
+    :param sr: Sampling rate of the chunks
+    :param kwargs: Further arguments of StreamIdentifier
+    :return: Generator yielding (song name, score, stream time in seconds) as soon as a song is identified
+    """
+    identifier = StreamIdentifier(database, ids_names, sr, **kwargs)
+    for chunk in chunks:
+        yield from identifier.feed(chunk)
+    yield from identifier.flush()
+
+
+def read_pcm(source, chunk_bytes=8192, dtype=np.int16, channels=1):
+    """
+    Read raw interleaved PCM from a file-like object (read()) or a socket (recv())
+    :param source: The file-like object or socket
+    :param chunk_bytes: Number of bytes requested per read
+    :param dtype: Integer or float sample type of the PCM data
+    :param channels: Number of interleaved channels
+    :return: Generator yielding float32 arrays of shape (frames, channels) scaled to [-1, 1]
+    """
+    read = source.recv if hasattr(source, "recv") else source.read
+    dtype = np.dtype(dtype)
+    frame_bytes = dtype.itemsize * channels
+    scale = float(np.iinfo(dtype).max) + 1 if dtype.kind == "i" else 1.0
+    pending = b""
+    while True:
+        data = read(chunk_bytes)
+        if not data:
+            break
+        pending += data
+        usable = len(pending) - len(pending) % frame_bytes
+        if usable == 0:
+            continue
+        samples = np.frombuffer(pending[:usable], dtype=dtype).reshape(-1, channels)
+        pending = pending[usable:]
+        yield samples.astype(np.float32) / scale
@@ -1,3 +1,8 @@
+import hashlib
+import os
+
+import numpy as np
+
 # Helper functions
 
 def mapFromTo(x,a,b,c,d):
@@ -11,4 +16,26 @@ def mapFromTo(x,a,b,c,d):
     :return: mapped
     """
     y = (x-a)/(b-a)*(d-c)+c
-    return y
\ No newline at end of file
+    return y
+
+def file_digest(path):
+    """
+    Computes the SHA-1 digest of a file's content
+    :param path: Path to the file
+    :return: The hex digest
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def save_atomic(path, array):
+    """
+    Save an array so that readers see either the old or the new file, never a partially written one
+    :param path: The *.npy file path
+    :param array: The array
+    :return: None
+    """
+    np.save(path + ".tmp.npy", array)
+    os.replace(path + ".tmp.npy", path)
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from scipy.ndimage import generate_binary_structure, iterate_structure
+
+import Fingerprint
+
+feature = pytest.importorskip("skimage.feature")
+
+
+def reference_peaks(spec, amp_min=None, max_per_frame=None):
+    """
+    The peak detector detect_peaks replaced: skimage's peak_local_max with a square footprint, followed by the
+    amplitude floor and the per-frame limit applied one peak at a time
+    :param spec: The spectrogram (frequency bins x frames)
+    :param amp_min: Optional amplitude floor, peaks must be above it
+    :param max_per_frame: Optional maximum number of peaks per frame
+    :return: The frames and frequency bins of the peaks, ordered by decreasing intensity
+    """
+    neighborhood = iterate_structure(generate_binary_structure(2, 2), Fingerprint.peak_neighbourhood_size)
+    freq_time = feature.peak_local_max(spec, footprint=neighborhood)
+    frames, freqs = freq_time[:, 1], freq_time[:, 0]
+
+    if amp_min is not None:
+        above = spec[freqs, frames] > amp_min
+        frames, freqs = frames[above], freqs[above]
+
+    if max_per_frame is not None:
+        kept = {}
+        keep = []
+        for frame in frames:
+            kept[frame] = kept.get(frame, 0) + 1
+            keep.append(kept[frame] <= max_per_frame)
+        keep = np.array(keep, dtype=bool)
+        frames, freqs = frames[keep], freqs[keep]
+
+    return frames, freqs
+
+
+def random_spec(shape, seed=0):
+    return np.random.default_rng(seed).normal(-40, 15, shape).astype(np.float32)
+
+
+def tied_spec(shape, seed=0):
+    # Few distinct values, so neighbourhoods are full of equal maxima
+    return np.random.default_rng(seed).integers(0, 4, shape).astype(np.float32)
+
+
+def plateau_spec(shape):
+    # Flat regions with a few steps: ties over whole neighbourhoods
+    spec = np.zeros(shape, dtype=np.float32)
+    spec[shape[0] // 3:, :] = 1
+    spec[:, shape[1] // 2:] += 1
+    return spec
+
+
+spectrograms = {
+    "random": random_spec((257, 400)),
+    "random_small": random_spec((40, 60), seed=1),
+    "tied": tied_spec((257, 300)),
+    "tied_binary": np.random.default_rng(2).integers(0, 2, (100, 120)).astype(np.float32),
+    "plateau": plateau_spec((90, 90)),
+    "constant": np.full((50, 70), -20, dtype=np.float32),
+    "single_frame": random_spec((257, 1), seed=3),
+    "single_bin": random_spec((1, 300), seed=4),
+    "two_by_two": random_spec((2, 2), seed=5),
+    "three_rows": random_spec((3, 200), seed=6),
+    "three_columns": random_spec((200, 3), seed=7),
+    "narrow": tied_spec((257, 10), seed=8),
+}
+
+
+def assert_same_peaks(spec, amp_min=None, max_per_frame=None):
+    frames, freqs = Fingerprint.detect_peaks(spec, amp_min, max_per_frame)
+    expected_frames, expected_freqs = reference_peaks(spec, amp_min, max_per_frame)
+    np.testing.assert_array_equal(frames, expected_frames)
+    np.testing.assert_array_equal(freqs, expected_freqs)
+
+
+@pytest.mark.parametrize("name", sorted(spectrograms))
+def test_matches_peak_local_max(name):
+    assert_same_peaks(spectrograms[name])
+
+
+@pytest.mark.parametrize("name", ["random", "tied", "plateau", "constant"])
+@pytest.mark.parametrize("amp_min", [-1000.0, -40.0, 0.0, 2.0, 1000.0])
+def test_amp_min(name, amp_min):
+    assert_same_peaks(spectrograms[name], amp_min=amp_min)
+
+
+@pytest.mark.parametrize("name", ["random", "tied", "tied_binary", "narrow"])
+@pytest.mark.parametrize("max_per_frame", [0, 1, 2, 5])
+def test_max_per_frame(name, max_per_frame):
+    assert_same_peaks(spectrograms[name], max_per_frame=max_per_frame)
+
+
+def test_amp_min_and_max_per_frame():
+    assert_same_peaks(spectrograms["random"], amp_min=-30.0, max_per_frame=1)
+    assert_same_peaks(spectrograms["tied"], amp_min=1.0, max_per_frame=2)